@@ -2,22 +2,23 @@
 import argparse
 import sys
 
-from src import ascii_art
-from src.commands import command_dict
+from src.commands import command_dict, visible_commands
 from src.tui import log_error
 
 
 def get_parser():
     parser = argparse.ArgumentParser()
+    # hidden commands can be run but aren't listed
     parser.add_argument("command",
                         help="command to run",
-                        choices=[cmd for cmd in command_dict if not command_dict[cmd].hidden])
+                        choices=list(command_dict),
+                        metavar="{" + ",".join(visible_commands()) + "}")
     return parser
 
 
 def main():
     # Art
-    #print(ascii_art)
+    #from src.art import ascii_art; print(ascii_art)
     
     # Parser args
     parser = get_parser()
@@ -1,13 +1,586 @@
-import subprocess
-import socket
-import os
+#!/usr/bin/env python3
+"""
+Serves service challenges over TCP, spawning the challenge program for every connection.
+
+    challenge-listener.py '<program>' <port>           one challenge (cron, systemd, docker)
+    challenge-listener.py --table listeners.json       every challenge in the table written by `ctf-tool.py build`
+
+The table is a json list of {"name", "port", "command", "user", "mode", "directory", "revision"}
+plus the server.ini settings in SETTINGS, which the listener enforces per challenge. With --table,
+SIGHUP reloads it: challenges whose entry changed are restarted, removed ones are stopped
+("revision" is only compared, it changes when the challenge's files were reinstalled).
+With --workers N every worker enforces 1/N (rounded up) of max_sessions and rate, since it only
+sees the connections the kernel gives it; warm_pool is kept by every worker.
+Standalone on purpose (stdlib only), it's copied onto challenge hosts and into challenge images.
+"""
 import argparse
+import asyncio
+import collections
+import fcntl
+import json
+import os
+import pwd
+import resource
+import shlex
+import signal
+import sys
+import termios
 import time
 
-parser = argparse.ArgumentParser()
-parser.add_argument("program", type=str)
-parser.add_argument("port")
-args = parser.parse_args()
 
-while 1:
-    os.system(f"socat TCP-LISTEN:{args.port},tcpwrap=script,reuseaddr,fork EXEC:'{args.program}',stderr,pty")
+READ_SIZE = 4096
+# like socat -t: after the client closes, how long the program gets to finish writing before it's killed
+CLOSE_TIMEOUT = 0.5
+RATE_WINDOW = 60.0
+BUSY_MESSAGE = b"Too many connections, try again later.\n"
+
+# server.ini settings a table entry can carry, also flags of the program/port form
+SETTINGS = {
+    "warm_pool": "instances to keep spawned ahead of connections",
+    "max_sessions": "concurrent connections, 0 = unlimited",
+    "rate": "new connections per minute from one source address, 0 = unlimited",
+    "session_timeout": "seconds a connection may last, 0 = unlimited",
+    "rlimit_cpu": "RLIMIT_CPU of the program in seconds, 0 = unlimited",
+    "rlimit_as": "RLIMIT_AS of the program in MB, 0 = unlimited",
+    "rlimit_nproc": "RLIMIT_NPROC of the challenge user, 0 = unlimited",
+}
+
+
+class Histogram(object):
+    """Cumulative bucket counts, sum and count, the Prometheus histogram layout"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        return {"buckets": [[bound, count] for bound, count in zip(self.BUCKETS, self.counts)],
+                "sum": self.sum, "count": self.count}
+
+
+class ServiceMetrics(object):
+    """In-process counters of one challenge, kept across reloads of its table entry"""
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.active = 0
+        self.connections = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.spawn_seconds = Histogram()    # connect until the program is ready, ~0 when served from the warm pool
+        self.session_seconds = Histogram()
+        self.exit_codes = collections.Counter()
+        self.recent = collections.deque()  # connection times within RATE_WINDOW
+
+    def connected(self):
+        now = time.monotonic()
+        self.connections += 1
+        self.recent.append(now)
+        while now - self.recent[0] > RATE_WINDOW:
+            self.recent.popleft()
+
+    @property
+    def connections_per_second(self):
+        now = time.monotonic()
+        return sum(1 for t in self.recent if now - t <= RATE_WINDOW) / RATE_WINDOW
+
+    def as_dict(self):
+        return {"name": self.name, "port": self.port, "active": self.active,
+                "connections": self.connections, "connections_per_second": self.connections_per_second,
+                "rejected": self.rejected, "timeouts": self.timeouts,
+                "spawn_seconds": self.spawn_seconds.as_dict(), "session_seconds": self.session_seconds.as_dict(),
+                "exit_codes": {str(code): count for code, count in self.exit_codes.items()}}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(metrics):
+    """Prometheus text exposition of a list of ServiceMetrics"""
+    lines = []
+    for name, kind, attr in (("connections_total", "counter", "connections"),
+                             ("rejected_total", "counter", "rejected"),
+                             ("timeouts_total", "counter", "timeouts"),
+                             ("active_sessions", "gauge", "active"),
+                             ("connections_per_second", "gauge", "connections_per_second")):
+        lines.append(f"# TYPE ctf_listener_{name} {kind}")
+        for m in metrics:
+            lines.append(f'ctf_listener_{name}{{challenge="{_label(m.name)}"}} {getattr(m, attr)}')
+    for name in ("spawn_seconds", "session_seconds"):
+        lines.append(f"# TYPE ctf_listener_{name} histogram")
+        for m in metrics:
+            histogram = getattr(m, name)
+            label = f'challenge="{_label(m.name)}"'
+            for bound, count in zip(histogram.BUCKETS, histogram.counts):
+                lines.append(f'ctf_listener_{name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'ctf_listener_{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"ctf_listener_{name}_sum{{{label}}} {histogram.sum}")
+            lines.append(f"ctf_listener_{name}_count{{{label}}} {histogram.count}")
+    lines.append("# TYPE ctf_listener_exits_total counter")
+    for m in metrics:
+        for code, count in sorted(m.exit_codes.items()):
+            lines.append(f'ctf_listener_exits_total{{challenge="{_label(m.name)}",code="{code}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """
+    Minimal HTTP endpoint for the daemon's metrics: /metrics is Prometheus text, /metrics.json is JSON.
+    Meant for localhost, it only answers GETs and closes every connection.
+    """
+    def __init__(self, daemon, host, port):
+        self.daemon = daemon
+        self.host = host
+        self.port = port
+        self.started = time.monotonic()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+
+    def json_body(self):
+        return json.dumps({"pid": os.getpid(), "uptime_seconds": time.monotonic() - self.started,
+                           "challenges": [m.as_dict() for m in self.daemon.metrics.values()]})
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            parts = request.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if parts[:1] != ["GET"]:
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "GET only\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", prometheus_text(list(self.daemon.metrics.values()))
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", self.json_body()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "try /metrics or /metrics.json\n"
+            body = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class Instance(object):
+    """A spawned copy of the challenge program, waiting for or serving one connection"""
+    def __init__(self, process, master=None):
+        self.process = process
+        self.master = master  # pty master fd, None in pipe mode
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    def kill(self):
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def close(self):
+        if self.master is not None:
+            os.close(self.master)
+            self.master = None
+
+
+def worker_share(limit, workers):
+    """A worker's part of a limit split over `workers` SO_REUSEPORT processes, at least 1, 0 stays unlimited"""
+    return -(-limit // max(1, workers)) if limit else 0
+
+
+class ChallengeService(object):
+    """
+    Accepts connections for one table entry and runs its command per connection.
+    With warm_pool > 0 that many instances are spawned ahead of time, each connection takes a
+    ready one (its early output is waiting in the pty/pipe) and the pool is refilled in the background.
+    """
+    def __init__(self, entry, host="0.0.0.0", reuse_port=False, metrics=None, workers=1):
+        self.entry = entry
+        self.name = entry.get("name") or str(entry["port"])
+        self.port = int(entry["port"])
+        self.metrics = metrics if metrics is not None else ServiceMetrics(self.name, self.port)
+        self.command = shlex.split(entry["command"])
+        self.user = entry.get("user")
+        self.mode = entry.get("mode", "pty")
+        self.directory = entry.get("directory")
+        self.warm_pool = int(entry.get("warm_pool", 0))
+        # every worker process only counts its own connections, so each enforces its share of the limits
+        self.max_sessions = worker_share(int(entry.get("max_sessions", 0)), workers)
+        self.rate = worker_share(int(entry.get("rate", 0)), workers)
+        self.session_timeout = int(entry.get("session_timeout", 0))
+        self.rlimits = [(limit, int(entry.get(name, 0)) * scale)
+                        for name, limit, scale in (("rlimit_cpu", resource.RLIMIT_CPU, 1),
+                                                   ("rlimit_as", resource.RLIMIT_AS, 1024 * 1024),
+                                                   ("rlimit_nproc", resource.RLIMIT_NPROC, 1))
+                        if int(entry.get(name, 0)) > 0]
+        self.active = 0
+        self.recent = dict()  # source address -> deque of connection times within RATE_WINDOW
+        self.host = host
+        self.reuse_port = reuse_port
+        self.server = None
+        self.pool = collections.deque()
+        self.filling = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                 reuse_address=True, reuse_port=self.reuse_port)
+        self.refill()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.filling is not None:
+            self.filling.cancel()
+        while self.pool:
+            instance = self.pool.popleft()
+            instance.kill()
+            await instance.process.wait()
+            instance.close()
+
+    def _preexec(self, controlling_tty=False):
+        """Runs in the child: take the pty as controlling terminal, apply the rlimits and drop to the challenge user"""
+        if controlling_tty:
+            fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+        for limit, value in self.rlimits:
+            resource.setrlimit(limit, (value, value))
+        if self.user and os.geteuid() == 0:
+            user = pwd.getpwnam(self.user)
+            os.initgroups(self.user, user.pw_gid)
+            os.setgid(user.pw_gid)
+            os.setuid(user.pw_uid)
+
+    def _env(self):
+        env = dict(os.environ)
+        if self.user:
+            try:
+                env["HOME"] = pwd.getpwnam(self.user).pw_dir
+            except KeyError:
+                pass
+        return env
+
+    async def spawn(self):
+        if self.mode == "pipe":
+            process = await asyncio.create_subprocess_exec(*self.command,
+                                                           stdin=asyncio.subprocess.PIPE,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT,
+                                                           cwd=self.directory, env=self._env(),
+                                                           preexec_fn=self._preexec, start_new_session=True)
+            return Instance(process)
+
+        master, slave = os.openpty()
+        try:
+            process = await asyncio.create_subprocess_exec(*self.command,
+                                                           stdin=slave, stdout=slave, stderr=slave,
+                                                           cwd=self.directory, env=self._env(),
+                                                           preexec_fn=lambda: self._preexec(controlling_tty=True),
+                                                           start_new_session=True)
+        except BaseException:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        os.set_blocking(master, False)
+        return Instance(process, master)
+
+    def refill(self):
+        """Tops the warm pool back up in the background, one spawn at a time"""
+        if self.warm_pool > 0 and (self.filling is None or self.filling.done()):
+            self.filling = asyncio.ensure_future(self._fill())
+
+    async def _fill(self):
+        while len(self.pool) < self.warm_pool:
+            try:
+                self.pool.append(await self.spawn())
+            except OSError as e:
+                print(f"{self.name}: can't pre-spawn: {e}", file=sys.stderr)
+                return
+
+    async def take(self):
+        """A warm instance if one is still running, a freshly spawned one otherwise"""
+        while self.pool:
+            instance = self.pool.popleft()
+            if instance.alive:
+                self.refill()
+                return instance
+            instance.close()
+        self.refill()
+        return await self.spawn()
+
+    def _over_rate(self, address):
+        """Sliding window count of connections from one source address"""
+        now = time.monotonic()
+        times = self.recent.setdefault(address, collections.deque())
+        while times and now - times[0] > RATE_WINDOW:
+            times.popleft()
+        if len(times) >= self.rate:
+            return True
+        times.append(now)
+        return False
+
+    def _forget_idle_sources(self):
+        now = time.monotonic()
+        for address in [address for address, times in self.recent.items() if not times or now - times[-1] > RATE_WINDOW]:
+            del self.recent[address]
+
+    def admit(self, writer):
+        """Whether a new connection is within max_sessions and its source's rate"""
+        if self.max_sessions and self.active >= self.max_sessions:
+            return False
+        if self.rate:
+            if len(self.recent) > 1024:
+                self._forget_idle_sources()
+            peer = writer.get_extra_info("peername")
+            if self._over_rate(peer[0] if peer else None):
+                return False
+        return True
+
+    async def handle(self, reader, writer):
+        metrics = self.metrics
+        metrics.connected()
+        if not self.admit(writer):
+            metrics.rejected += 1
+            writer.write(BUSY_MESSAGE)
+            writer.close()
+            return
+        self.active += 1
+        metrics.active += 1
+        start = time.monotonic()
+        try:
+            instance = await self.take()
+            metrics.spawn_seconds.observe(time.monotonic() - start)
+            try:
+                session = self.pipe_session if instance.master is None else self.pty_session
+                if self.session_timeout:
+                    await asyncio.wait_for(session(instance, reader, writer), self.session_timeout)
+                else:
+                    await session(instance, reader, writer)
+            except asyncio.TimeoutError:
+                metrics.timeouts += 1
+            finally:
+                instance.kill()
+                writer.close()  # before the pty is closed, nothing reads from the client any more
+                instance.close()
+            metrics.exit_codes[await instance.process.wait()] += 1
+        except Exception as e:
+            print(f"{self.name}: {e!r}", file=sys.stderr)
+        finally:
+            self.active -= 1
+            metrics.active -= 1
+            metrics.session_seconds.observe(time.monotonic() - start)
+            writer.close()
+
+    async def _finish(self, instance, output_done, client_done):
+        """
+        Waits for the program's output to end; if the client leaves first give the program CLOSE_TIMEOUT, then kill it.
+        Both directions are stopped even when the session is cancelled (session_timeout), so no client input
+        is written to a pty after it was closed.
+        """
+        try:
+            done, _ = await asyncio.wait([output_done, client_done], return_when=asyncio.FIRST_COMPLETED)
+            if output_done not in done:
+                try:
+                    await asyncio.wait_for(asyncio.shield(output_done), CLOSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            output_done.cancel()
+            client_done.cancel()
+            await asyncio.gather(output_done, client_done, return_exceptions=True)
+        instance.kill()
+        await instance.process.wait()
+
+    async def pipe_session(self, instance, reader, writer):
+        process = instance.process
+
+        async def client_to_program():
+            try:
+                while True:
+                    data = await reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+                    await process.stdin.drain()
+            finally:
+                process.stdin.close()
+
+        async def program_to_client():
+            while True:
+                data = await process.stdout.read(READ_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+        await self._finish(instance,
+                           asyncio.ensure_future(program_to_client()),
+                           asyncio.ensure_future(client_to_program()))
+
+    async def pty_session(self, instance, reader, writer):
+        loop = asyncio.get_event_loop()
+        master = instance.master
+        output_done = loop.create_future()
+
+        def program_to_client():
+            try:
+                data = os.read(master, READ_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:  # EIO once the program and everything it spawned closed the pty
+                data = b""
+            if data:
+                writer.write(data)
+            else:
+                loop.remove_reader(master)
+                if not output_done.done():
+                    output_done.set_result(None)
+
+        async def client_to_program():
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    try:
+                        data = data[os.write(master, data):]
+                    except BlockingIOError:
+                        await asyncio.sleep(0.01)
+
+        loop.add_reader(master, program_to_client)
+        try:
+            await self._finish(instance, output_done, asyncio.ensure_future(client_to_program()))
+        finally:
+            loop.remove_reader(master)
+
+
+class ListenerDaemon(object):
+    """Every ChallengeService of a table in one event loop"""
+    def __init__(self, entries=None, table_path=None, host="0.0.0.0", reuse_port=False, metrics_address=None, workers=1):
+        self.entries = entries
+        self.workers = workers
+        self.table_path = table_path
+        self.host = host
+        self.reuse_port = reuse_port
+        self.metrics_address = metrics_address  # (host, port) of the metrics endpoint, None for none
+        self.services = dict()  # port -> ChallengeService
+        self.metrics = dict()   # (name, port) -> ServiceMetrics
+
+    def load_table(self):
+        if self.table_path is None:
+            return self.entries
+        with open(self.table_path) as f:
+            return json.load(f)
+
+    async def reload(self):
+        wanted = {int(entry["port"]): entry for entry in self.load_table()}
+        for port, service in list(self.services.items()):
+            if wanted.get(port) != service.entry:
+                await service.stop()
+                del self.services[port]
+        for port, entry in wanted.items():
+            if port not in self.services:
+                service = ChallengeService(entry, self.host, self.reuse_port, workers=self.workers)
+                service.metrics = self.metrics.setdefault((service.name, port), service.metrics)
+                try:
+                    await service.start()
+                except OSError as e:
+                    print(f"{service.name}: can't listen on {port}: {e}", file=sys.stderr)
+                    continue
+                self.services[port] = service
+        print(f"listening for {len(self.services)} challenges", file=sys.stderr)
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        stop = loop.create_future()
+        await self.reload()
+        if self.metrics_address is not None:
+            await MetricsServer(self, *self.metrics_address).start()
+        if self.table_path is not None:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        await stop
+        for service in self.services.values():
+            await service.stop()
+
+
+def run_workers(daemon, workers):
+    """Forks `workers` copies of the daemon sharing the ports with SO_REUSEPORT, the parent only forwards signals"""
+    children = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            if daemon.metrics_address is not None:
+                # every worker has its own counters, worker n serves them on the metrics port + n
+                host, port = daemon.metrics_address
+                daemon.metrics_address = (host, port + worker)
+            asyncio.run(daemon.serve())
+            os._exit(0)
+        children.append(pid)
+
+    def forward(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signum)
+            except ProcessLookupError:
+                pass
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, forward)
+    for child in children:
+        os.waitpid(child, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("program", type=str, nargs="?", help="command to run per connection")
+    parser.add_argument("port", nargs="?")
+    parser.add_argument("--table", help="json table of challenges written by ctf-tool.py build")
+    parser.add_argument("--mode", choices=["pty", "pipe"], default="pty",
+                        help="program/port form only: give the program a pty (like socat pty) or plain pipes")
+    for name, help in SETTINGS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=0, help=f"program/port form only: {help}")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing every port with SO_REUSEPORT, max_sessions and rate are split between them")
+    parser.add_argument("--metrics", metavar="HOST:PORT",
+                        help="serve metrics on http://HOST:PORT/metrics (Prometheus) and /metrics.json, with --workers "
+                             "worker n uses PORT + n")
+    args = parser.parse_args()
+
+    if args.table is None and (args.program is None or args.port is None):
+        parser.error("give either a program and a port or --table")
+
+    entries = None
+    if args.table is None:
+        entry = {"name": args.program, "port": int(args.port), "command": args.program, "mode": args.mode}
+        entry.update({name: getattr(args, name) for name in SETTINGS})
+        entries = [entry]
+    metrics_address = None
+    if args.metrics is not None:
+        host, _, port = args.metrics.rpartition(":")
+        metrics_address = (host or "127.0.0.1", int(port))
+    daemon = ListenerDaemon(entries, args.table, args.host, reuse_port=args.workers > 1, metrics_address=metrics_address,
+                            workers=args.workers)
+
+    if args.workers > 1:
+        run_workers(daemon, args.workers)
+    else:
+        asyncio.run(daemon.serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+
+READ_CHUNK_SIZE = 1 << 20
+DEFAULT_MAX_ARCHIVE_SIZE = 512 * 1024 * 1024  # uncompressed bytes
+DEFAULT_MAX_RATIO = 100                       # uncompressed / compressed size of a single member
+VERIFIER_VERSION = 1  # bump when verify_archive's checks change, cached problems of other versions are dropped
+
+
+class ArchiveCheck(object):
+    """Result of verifying every member of one zip file"""
+    def __init__(self, path):
+        self.path = path
+        self.members = 0
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.start = None  # time.monotonic()
+        self.seconds = 0.0
+        self.problems = []
+
+    def as_dict(self):
+        return {"path": self.path, "members": self.members, "compressed_bytes": self.compressed_bytes,
+                "uncompressed_bytes": self.uncompressed_bytes, "seconds": self.seconds, "problems": self.problems}
+
+
+def _read_member(archive, info, check):
+    """Streams one member through zipfile's CRC check, never holding more than a chunk in memory"""
+    read = 0
+    with archive.open(info) as member:
+        while True:
+            chunk = member.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+            if read > info.file_size:
+                # zipfile stops at the declared size, this is just belt and braces
+                check.problems.append(f"{info.filename} inflates past its declared size")
+                return read
+    return read
+
+
+def verify_archive(path, max_size=DEFAULT_MAX_ARCHIVE_SIZE, max_ratio=DEFAULT_MAX_RATIO) -> ArchiveCheck:
+    """
+    CRC checks every member of a zip and flags duplicate members, members with a zip bomb like
+    compression ratio and archives whose declared uncompressed size is over max_size.
+    Suspicious members are not inflated.
+    """
+    check = ArchiveCheck(path)
+    start = check.start = time.monotonic()
+    try:
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+            check.members = len(infos)
+
+            seen = set()
+            for info in infos:
+                if info.filename in seen:
+                    check.problems.append(f"duplicate member {info.filename}")
+                seen.add(info.filename)
+
+            declared_size = sum(info.file_size for info in infos)
+            if declared_size > max_size:
+                check.problems.append(f"uncompressed size {declared_size} bytes is over the limit of {max_size}")
+
+            for info in infos:
+                if info.is_dir():
+                    continue
+                if info.file_size > max_ratio * max(info.compress_size, 1) and info.file_size > READ_CHUNK_SIZE:
+                    check.problems.append(f"{info.filename} has a compression ratio over {max_ratio}:1, possible zip bomb")
+                    continue
+                if declared_size > max_size:
+                    continue
+                check.compressed_bytes += info.compress_size
+                check.uncompressed_bytes += _read_member(archive, info, check)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error, EOFError, OSError, NotImplementedError) as e:
+        check.problems.append(f"corrupt archive: {e}")
+    check.seconds = time.monotonic() - start
+    return check
+
+
+def verify_archives(paths: List[str], jobs=1, max_size=DEFAULT_MAX_ARCHIVE_SIZE, max_ratio=DEFAULT_MAX_RATIO) -> List[ArchiveCheck]:
+    """Verifies archives in parallel, zlib and crc32 release the GIL so threads scale. Results are in input order"""
+    with ThreadPoolExecutor(max_workers=max(1, jobs or 1)) as pool:
+        return list(pool.map(lambda path: verify_archive(path, max_size, max_ratio), paths))
+
+
+def throughput(checks: List[ArchiveCheck], seconds):
+    """MB/s of compressed archive data read over a wall clock time"""
+    if seconds <= 0:
+        return 0.0
+    return sum(check.compressed_bytes for check in checks) / (1024 * 1024) / seconds
+
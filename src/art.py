@@ -0,0 +1,44 @@
+ascii_art = """                                                                                                              
+                                                  .:l,                                                        
+                                                 oXX0cc;                                                      
+                                              .ox:oclKXX0:                                                    
+                                            .dXXOcc:dXXXXX0:                                                  
+                                          .dXXOclKXXx:dXXXXXKc                                                
+                                        .dXXOclKXXXXXXx:oXXXXX0c                                              
+                                    . .xXXO:lKXXXXXXXXXXk:oKXXXXKc                                            
+                                 l0XXOXXO:oKXXXXXXXXXXXXXXk:oKXXXXK.                                          
+                               'KXXXXXk:oK0XXXXXXXXXXXXXXXXXk:oKXo:kK.                                        
+                               oKXXXk:oO00XXXXXXXXXXXXXXXXXXXXd..xXXx.                                        
+                              .kXXk:oK00KXXXXXXXXXXXXXXXXXXX0:'dd;c.                                          
+                            .xXXk:oK00KXXXXXXXXXXXXXXXXXXXXo;oO0d.                                            
+                          'kXXk:oKK0KXXXXXXXXXXXXXXXXXXXXo:OX0o.                                              
+                        'kXXk:oKK0XXXXXXXXXXXXXXXXXXXXKo:kXXx.                                                
+                      'kXXx:dXXXXXXXXXXXXXXXXXXXXXXXKl:OXXd.                                                  
+                    ',xXx:dXXXXXXXXXXXXXXXXXXXXXXXKl:OXXd.                                                    
+                  'kXX;.,XXXXXXXXXXXXXXXXXXXXXXXKl:OXXXl                                                      
+                  xXx:xXx:dXXXXXXXXXXXXXXXXXXXKlcOXXXXXX0;                                                    
+                   .lXXXXXx:dXXXXXXXXXXXXXXXKlcOXXkXXXXXXX0;                                                  
+                     ,OXXXXXk:oXXXXXXXXXXX0cc0XXo. .oXXXXXXX0:                                                
+                       ,OXXXXXk:oXXXXXXXKcc0XKo.     .oXXXXXXX0:                                              
+                         ,OXXXXXk:oKXX0cc0XKl.          lKXXXXXOl;                                            
+                           'kXXXXXk;c::kKKl               lKX0kcxxl'                                          
+                             'kXXX0,;;:x:                   ,OxxKXlOx.                                        
+                               'dclxkx'                       .xkoo0Xo0c                                      
+                                 .odc                           cckkdlkk:c                                    
+                                                                  :KoXKkckx.                                  
+                                                                    .xkcXX0dK;                                
+                                                                      ;ckkckOOll                              
+                                                                        :xd0kcxkd'.                           
+                                                                          .k0dXXoOk,                          
+                                                                            .dkxl0XdOl                        
+                                                                              :ckkxckkx::dOo                  
+                                                                                ;0oKOO0XXXX,                  
+                                                                                  'x0XXXX0'                   
+                                                                                  .0XXX0o.                    
+                                                                                  ,kd:.                       
+   mmm mmmmmmm mmmmmm       mmmmmmm  mmmm   mmmm  m     
+ m"   "   #    #               #    m"  "m m"  "m #     
+ #        #    #mmmmm          #    #    # #    # #     
+ #        #    #       "'"     #    #    # #    # #     
+  "mmm"   #    #               #     #mm#   #mm#  #mmmmm
+"""
@@ -0,0 +1,221 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import List, Tuple
+
+from src import version
+
+
+RESULTS_VERSION = 1
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+BENCH_DIR = os.path.join("output", "bench")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASE_ZIP_PATH = os.path.join(REPO_DIR, "resources", "ctfd.base.zip")
+
+
+def _write(path, data):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def _payload(rng, size):
+    """Half incompressible, half repetitive bytes, roughly what challenge files look like to zlib"""
+    half = size // 2
+    noise = rng.getrandbits(8 * half).to_bytes(half, "little") if half else b""
+    return noise + b"A" * (size - half)
+
+
+def generate_pack(path, challenges, categories=10, makefile_share=0.1, server_share=0.1, zip_size=4096, seed=0):
+    """
+    Writes a synthetic challenge pack in the <pack>/<category>/<challenge> layout of docs/DIR-STRUCTURE.MD.
+    makefile_share and server_share are the fractions of challenges with a Makefile and with
+    requires-server/server.zip, zip_size the size of the file inside every challenge.zip.
+    The same arguments always generate the same pack. Returns counts of what was generated.
+    """
+    rng = random.Random(seed)
+    counts = {"challenges": 0, "makefiles": 0, "servers": 0}
+    for i in range(challenges):
+        directory = os.path.join(path, f"category-{i % max(1, categories):03d}", f"challenge-{i:05d}")
+        os.makedirs(directory, exist_ok=True)
+        _write(os.path.join(directory, "flag.txt"), f"flag{{bench_{i:05d}_{rng.getrandbits(32):08x}}}\n")
+        _write(os.path.join(directory, "message.txt"), f"Synthetic benchmark challenge {i}.\n")
+        _write(os.path.join(directory, "value.txt"), f"{rng.choice((50, 100, 200, 300, 500))}\n")
+        with zipfile.ZipFile(os.path.join(directory, "challenge.zip"), "w", zipfile.ZIP_DEFLATED) as challenge_zip:
+            challenge_zip.writestr("challenge.bin", _payload(rng, zip_size))
+        counts["challenges"] += 1
+
+        if rng.random() < makefile_share:
+            _write(os.path.join(directory, "Makefile"), "all:\n\t@echo built > build.log\n\nclean:\n\t@rm -f build.log\n")
+            counts["makefiles"] += 1
+
+        if rng.random() < server_share:
+            _write(os.path.join(directory, "requires-server"), "server.py\n")
+            with zipfile.ZipFile(os.path.join(directory, "server.zip"), "w", zipfile.ZIP_DEFLATED) as server_zip:
+                server_zip.writestr("server.py", "#!/usr/bin/env python3\nprint(open('flag.txt').read())\n")
+                server_zip.writestr("flag.txt", f"flag{{bench_{i:05d}}}\n")
+            counts["servers"] += 1
+    return counts
+
+
+def _run_command(command, argline):
+    """Runs a command in-process with its output discarded, returns (seconds, exit code)"""
+    start = time.monotonic()
+    code = 0
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        try:
+            command(argline)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+    return time.monotonic() - start, code
+
+
+@contextlib.contextmanager
+def _scratch_directory():
+    """Runs the block in a temporary working directory, so its output/ (ports.json, .cache, build folders) is thrown away"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="ctf-tool-bench.") as scratch:
+        os.chdir(scratch)
+        try:
+            yield scratch
+        finally:
+            os.chdir(cwd)
+
+
+def bench_size(pack, size, jobs=1, warm=False):
+    """
+    Times validate and build on one generated pack, returns their result rows.
+    The commands run in a scratch working directory with their own port registry and cache,
+    pack has to be an absolute path.
+    """
+    # imported here so the generator works without the commands' dependencies
+    from src.commands.build import Buildcmd
+    from src.commands.validate import Validatecmd
+
+    runs = []
+    cache_args = [] if warm else ["--no-cache"]
+
+    with _scratch_directory():
+        validate = Validatecmd()
+        if warm:
+            _run_command(Validatecmd(), [pack, "--no-make", "-j", str(jobs)])
+        seconds, code = _run_command(validate, [pack, "--no-make", "-j", str(jobs)] + cache_args)
+        runs.append({"size": size, "command": "validate", "cache": "warm" if warm else "cold",
+                     "seconds": seconds, "failed": code != 0, "stages": validate.profiler.stage_totals()})
+
+        build_args = ["--basezip", BASE_ZIP_PATH, "-j", str(jobs)]
+        build = Buildcmd()
+        if warm:
+            # its own name, build output folders are named to the second
+            _run_command(Buildcmd(), ["--name", f"bench-{size}-prime"] + build_args + [pack])
+        seconds, code = _run_command(build, ["--name", f"bench-{size}"] + build_args + cache_args + [pack])
+        runs.append({"size": size, "command": "build", "cache": "warm" if warm else "cold",
+                     "seconds": seconds, "failed": code != 0, "stages": build.profiler.stage_totals()})
+    return runs
+
+
+def run_bench(sizes=DEFAULT_SIZES, workdir=os.path.join(BENCH_DIR, "packs"), jobs=1, warm=False, **generator_args):
+    """
+    Generates (or reuses) a pack of every size and times each stage of validate and build on it.
+    Returns a results document, see save_results.
+    """
+    results = {"version": RESULTS_VERSION,
+               "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "tool_version": version,
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "params": dict(generator_args, jobs=jobs, warm=warm),
+               "runs": []}
+    for size in sizes:
+        pack = os.path.abspath(os.path.join(workdir, "pack-" + "-".join(
+            [str(size)] + [f"{key}={value}" for key, value in sorted(generator_args.items())])))
+        start = time.monotonic()
+        if not os.path.isdir(pack):
+            generate_pack(pack, size, **generator_args)
+        results["runs"].append({"size": size, "command": "generate", "cache": "none",
+                                "seconds": time.monotonic() - start, "failed": False, "stages": {}})
+        results["runs"] += bench_size(pack, size, jobs, warm)
+    return results
+
+
+def save_results(results, path=None):
+    """Writes results as JSON to path, default output/bench/bench-<created>.json. Returns the path"""
+    if path is None:
+        path = os.path.join(BENCH_DIR, f"bench-{results['created'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+class StageChange(object):
+    """One stage of one run compared between two results documents"""
+    def __init__(self, size, command, cache, stage, old, new):
+        self.size = size
+        self.command = command
+        self.cache = cache
+        self.stage = stage
+        self.old = old
+        self.new = new
+
+    @property
+    def ratio(self):
+        return self.new / self.old if self.old else float("inf")
+
+    def regressed(self, threshold, min_seconds):
+        return self.new - self.old > min_seconds and self.ratio > 1 + threshold
+
+
+def compare_results(old, new) -> List[StageChange]:
+    """Every stage (and the total, as stage "total") present in both documents"""
+    old_runs = {(run["size"], run["command"], run["cache"]): run for run in old["runs"]}
+    changes = []
+    for run in new["runs"]:
+        key = (run["size"], run["command"], run["cache"])
+        if key not in old_runs:
+            continue
+        old_run = old_runs[key]
+        for stage, seconds in run["stages"].items():
+            if stage in old_run["stages"]:
+                changes.append(StageChange(*key, stage, old_run["stages"][stage], seconds))
+        changes.append(StageChange(*key, "total", old_run["seconds"], run["seconds"]))
+    return changes
+
+
+TOOL_PATH = os.path.join(REPO_DIR, "ctf-tool.py")
+
+
+def startup_time(command, runs=10) -> float:
+    """Median wall clock seconds of `ctf-tool.py <command> --help` in a fresh interpreter"""
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run([sys.executable, TOOL_PATH, command, "--help"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+    return statistics.median(times)
+
+
+def heaviest_imports(command, top=10) -> List[Tuple[str, float]]:
+    """(module, cumulative seconds) of the slowest top level imports of a command, from -X importtime"""
+    process = subprocess.run([sys.executable, "-X", "importtime", TOOL_PATH, command, "--help"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.partition("import time:")[2].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        module = fields[2].rstrip()
+        if module.startswith("  "):
+            continue  # nested, already counted in its parent's cumulative time
+        imports.append((module.strip(), int(fields[1]) / 1e6))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:top]
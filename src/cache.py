@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not Linux, reflinks are never attempted
+    fcntl = None
+
+
+CACHE_DIR = os.path.join("output", ".cache")
+MANIFEST_VERSION = 2
+
+# ioctl(dst, FICLONE, src) shares the extents of src with dst on btrfs/xfs/bcachefs
+FICLONE = 0x40049409
+
+
+def sha256_of(path, chunk_size=1 << 20):
+    """Content hash of a single file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_file_range(fsrc, fdst):
+    """Kernel side copy, returns False if nothing could be copied and the caller should fall back"""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    while True:
+        try:
+            sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30)
+        except OSError:
+            if copied == 0:
+                return False
+            raise
+        if sent == 0:
+            return True
+        copied += sent
+
+
+def fast_copy(src, dst):
+    """
+    Copies a file the cheapest way the filesystem allows: a reflink, then copy_file_range,
+    and a plain byte copy only as the fallback. Metadata is copied like shutil.copy2.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            if fcntl is None:
+                raise OSError("reflinks not supported")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            if not _copy_file_range(fsrc, fdst):
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+class BuildCache(object):
+    """
+    Persistent build state kept in output/.cache/manifest between builds.
+    File hashes are keyed on (size, mtime) like a git index so unchanged files are never re-read,
+    challenge directories hash to the combination of their file hashes.
+    """
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest")
+        self.files = dict()  # abs path -> [size, mtime_ns, sha256]
+        self.built = dict()  # abs challenge dir -> directory digest after a successful make
+        self.validated = dict()  # abs challenge dir -> [validator version, file fingerprint, findings] from the last validation
+        self.archives = dict()  # abs archive path -> [rules, size, mtime_ns, problems] from the last deep validation
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        self.files = manifest.get("files", {})
+        self.built = manifest.get("built", {})
+        self.validated = manifest.get("validated", {})
+        self.archives = manifest.get("archives", {})
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": self.files, "built": self.built,
+                       "validated": self.validated, "archives": self.archives}, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def file_digest(self, path, stat=None):
+        """sha256 of a file, only re-hashed when its size or mtime changed"""
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = sha256_of(path)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def directory_digest(self, directory):
+        """Content hash of everything under a challenge directory (names and file contents)"""
+        directory = os.path.abspath(directory)
+        entries = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                entries.append(f"{os.path.relpath(path, directory)}\0{self.file_digest(path)}")
+        return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+    def is_built(self, directory):
+        """True if make already ran successfully on exactly the current contents of directory"""
+        directory = os.path.abspath(directory)
+        return directory in self.built and self.built[directory] == self.directory_digest(directory)
+
+    def mark_built(self, directory):
+        directory = os.path.abspath(directory)
+        self.built[directory] = self.directory_digest(directory)
+
+    def validated_findings(self, entry, version):
+        """
+        Findings from the last validation of a pack index entry, None if any of its files changed since
+        or it was validated by another version of the checks
+        """
+        cached = self.validated.get(entry.directory)
+        if cached is not None and cached[0] == version and cached[1] == entry.fingerprint():
+            return cached[2]
+        return None
+
+    def mark_validated(self, entry, findings, version):
+        self.validated[entry.directory] = [version, entry.fingerprint(), findings]
+
+    def archive_problems(self, path, size, mtime_ns, rules):
+        """Problems found by the last deep check of an archive, None if it changed or was checked under other rules"""
+        cached = self.archives.get(os.path.abspath(path))
+        if cached is not None and cached[0] == rules and cached[1] == size and cached[2] == mtime_ns:
+            return cached[3]
+        return None
+
+    def mark_archive(self, path, size, mtime_ns, problems, rules):
+        self.archives[os.path.abspath(path)] = [rules, size, mtime_ns, problems]
+
+
+class BlobStore(object):
+    """
+    Content-addressed copies of staged files in output/.cache/blobs. Every distinct file is copied
+    into the store once; staging it anywhere else is a hardlink to that blob, or a fast_copy when
+    the destination is going to be modified (chown/chmod) or lives on another filesystem.
+    """
+    def __init__(self, cache, blob_dir=None):
+        self.cache = cache
+        self.blob_dir = blob_dir or os.path.join(cache.cache_dir, "blobs")
+
+    def blob(self, src):
+        """Path of the blob holding src's contents, copying it in if it's new"""
+        blob_path = os.path.join(self.blob_dir, self.cache.file_digest(src))
+        if not os.path.exists(blob_path):
+            os.makedirs(self.blob_dir, exist_ok=True)
+            fast_copy(src, blob_path + ".tmp")
+            os.replace(blob_path + ".tmp", blob_path)
+        return blob_path
+
+    def stage(self, src, dst, link=True):
+        """Places a copy of src at dst (a file path or an existing directory)"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        blob_path = self.blob(src)
+        if link:
+            try:
+                os.link(blob_path, dst)
+                return dst
+            except OSError:
+                pass
+        fast_copy(blob_path, dst)
+        return dst
+
+
+def stage_file(src, dst, blobs=None, link=True):
+    """Stages src at dst through a BlobStore, or with fast_copy when there is none"""
+    if blobs is not None:
+        return blobs.stage(src, dst, link)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    fast_copy(src, dst)
+    return dst
@@ -1,107 +1,171 @@
 import os
-import random
-import shutil
-import tempfile
 import re
 import textwrap
-from typing import List
+from collections import defaultdict
+from typing import Iterable, Iterator, List
 
+from src.cache import sha256_of
+from src.make import DEFAULT_LOG_DIR, MakeResult, report_make_results, run_make_jobs
+from src.pack import ChallengeEntry, PackIndex
+from src.server_config import ServerConfig
 from src.util import EmptyConfigFileError
 from src.util import contents_of
+from src.tui import log_normal
 
 
-# literally just a token class for challenge to abuse
-# TODO: there is probably a way around using this
+# Lightweight rows of the CTFd tables, the columns are the __slots__ of each subclass
 class _chal_rep(object):
-    def __init__(self):
-        return
+    __slots__ = ()
+
+    def __init__(self, **columns):
+        for column in self.__slots__:
+            setattr(self, column, columns.get(column))
+
+    def as_dict(self):
+        return {column: getattr(self, column) for column in self.__slots__}
+
+
+class _challenge_rep(_chal_rep):
+    __slots__ = ("id", "name", "description", "max_attempts", "value", "category", "type", "state", "requirements")
+
+
+class _flag_rep(_chal_rep):
+    __slots__ = ("id", "challenge_id", "type", "content", "data")
+
+
+class _file_rep(_chal_rep):
+    __slots__ = ("id", "type", "location", "challenge_id", "page_id")
+
+
+_UNREAD = object()
+
+DOCKER_BASE_IMAGE = "ctf-tool/challenge-base"
+# Port the listener binds inside every challenge container, published on the challenge's port.
+# Keeping it out of the image keeps the build context (and so the image) the same across builds
+DOCKER_CHALLENGE_PORT = 31337
 
 
 class Challenge(object):
-    def __init__(self, abs_directory):
+    __slots__ = ("directory", "entry", "id", "name", "category",
+                 "_flag", "_description", "_max_attempts", "_value", "_upload_location",
+                 "requires_server_path", "server_zip_path", "username", "crontab_path", "port",
+                 "requires_server_string", "listener_command", "_server_config")
+
+    # Standard Challenge, same for every challenge
+    challenge_binary = "" # use for challenge.zip?
+    type = 'standard'
+    state = 'visible'
+    requirements = None
+
+    def __init__(self, abs_directory, entry=None):
         # Local fs info
         self.directory = abs_directory
-        self.challenge_binary = "" # use for challenge.zip?
+        self.entry = entry if entry is not None else ChallengeEntry.from_directory(abs_directory)
 
-        # Standard Challenge
+        # Standard Challenge, text fields are read from disk on first use
         self.id = None
         self.name = os.path.basename(abs_directory)
-        self.flag = contents_of(os.path.join(abs_directory,"flag.txt"))
-        self.description = contents_of(os.path.join(abs_directory, 'message.txt')).strip()
-        self.max_attempts = int(contents_of(os.path.join(abs_directory, "max-attempts")) if os.path.exists(os.path.join(abs_directory,"max-attempts")) else 0) # TODO: no demo yet
-        self.value = int(contents_of(os.path.join(abs_directory, 'value.txt')))
-        self.category = os.path.basename(os.path.dirname(abs_directory))
-        self.type = 'standard'
-        self.state = 'visible'
-        self.requirements = None
-        
+        self.category = self.entry.category
+        self._flag = _UNREAD
+        self._description = _UNREAD
+        self._max_attempts = _UNREAD
+        self._value = _UNREAD
+        self._upload_location = None
+
         # Server Challenge
         self.requires_server_path = None
         self.server_zip_path = None
         self.username = None
         self.crontab_path = None
-        self.port = random.randint(48620, 49150)
+        self.port = None  # assigned by a PortRegistry for service challenges
         self.requires_server_string = None
         self.listener_command = None
-
-        # Files
-        self.has_challenge_zip = os.path.exists(os.path.join(abs_directory,"challenge.zip"))
+        self._server_config = None
 
         return
 
+    @property
+    def flag(self):
+        if self._flag is _UNREAD:
+            self._flag = contents_of(os.path.join(self.directory, "flag.txt"))
+        return self._flag
+
+    @property
+    def description(self):
+        if self._description is _UNREAD:
+            self._description = contents_of(os.path.join(self.directory, 'message.txt')).strip()
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+
+    @property
+    def max_attempts(self):
+        if self._max_attempts is _UNREAD:
+            self._max_attempts = int(contents_of(os.path.join(self.directory, "max-attempts")) if self.entry.has("max-attempts") else 0) # TODO: no demo yet
+        return self._max_attempts
+
+    @property
+    def value(self):
+        if self._value is _UNREAD:
+            self._value = int(contents_of(os.path.join(self.directory, 'value.txt')))
+        return self._value
+
+    # Files
+    @property
+    def has_challenge_zip(self):
+        return self.entry.has("challenge.zip")
+
     def __repr__(self):
         # prints the json repr of what ctfd needs, don't add anyhting else becasue it will break ctfd
         return f"'{self.id}','{self.name}','{self.description}','{self.max_attempts}','{self.value}','{self.category}','{self.type}','{self.state}','{self.requirements}'"
 
     def ctfd_repr(self):
-        retVal = _chal_rep()
-        retVal.id = self.id
-        retVal.name = self.name
-        retVal.description = self.description
-        retVal.max_attempts = self.max_attempts
-        retVal.value = self.value
-        retVal.category = self.category
-        retVal.type = self.type
-        retVal.state = self.state
-        retVal.requirements = self.requirements
-        return retVal
+        return _challenge_rep(id=self.id,
+                              name=self.name,
+                              description=self.description,
+                              max_attempts=self.max_attempts,
+                              value=self.value,
+                              category=self.category,
+                              type=self.type,
+                              state=self.state,
+                              requirements=self.requirements)
 
     def ctfd_flag_repr(self):
-        retVal = _chal_rep()
-        retVal.id = None                # to be set later
-        retVal.challenge_id = self.id   # The associated challenge id
-        retVal.type = "static"          # "static" or whatever the value for regular expression is
-        retVal.content = self.flag      # the flag string or regex
-        retVal.data = None              # ??? maybe something with regex
-        return retVal
-    
-    def copy_zip_file_to_temp(self,tempdir):
-        if os.path.exists(f"{self.directory}/challenge.zip"):
-            filename = "_".join(self.name.split(" "))
-            os.makedirs(os.path.join(tempdir,filename))
-            shutil.copy2(
-                os.path.join(
-                    self.directory,
-                    "challenge.zip"
-                ),
-                os.path.join(
-                    tempdir,
-                    f"{filename}/{filename}.zip"
-                )
-            )
+        return _flag_rep(id=None,                # to be set later
+                         challenge_id=self.id,   # The associated challenge id
+                         type="static",          # "static" or whatever the value for regular expression is
+                         content=self.flag,      # the flag string or regex
+                         data=None)              # ??? maybe something with regex
+
+    @property
+    def upload_location(self):
+        """Where challenge.zip lives under uploads/ in the CTFd export, renamed after the challenge
+        unless dedupe_uploads pointed it at an identical upload of another challenge"""
+        if self._upload_location is not None:
+            return self._upload_location
+        filename = "_".join(self.name.split(" "))
+        return f"{filename}/{filename}.zip"
+
+    @upload_location.setter
+    def upload_location(self, location):
+        self._upload_location = location
+
+    def add_zip_file_to_export(self, export):
+        # shared uploads are only written by the first challenge that uses them
+        if self.has_challenge_zip and f"uploads/{self.upload_location}" not in export.names:
+            export.add_file(f"uploads/{self.upload_location}", os.path.join(self.directory, "challenge.zip"))
         return
 
     def ctfd_file_list(self):
-        retVal = _chal_rep()
-        filename = "_".join(self.name.split(" "))
-        if self.has_challenge_zip:            
-            # Build obj
-            retVal.id = None
-            retVal.type = "challenge"
-            retVal.location = f"{filename}/{filename}.zip"
-            retVal.challenge_id = self.id
-            retVal.page_id = None
-        return retVal
+        if not self.has_challenge_zip:
+            return None
+        return _file_rep(id=None,
+                         type="challenge",
+                         location=self.upload_location,
+                         challenge_id=self.id,
+                         page_id=None)
 
     def set_requires_server_string(self):
         with open(self.requires_server_path, "r") as f:
@@ -120,26 +184,48 @@ class Challenge(object):
 
         self.requires_server_string = requires_server_string
 
+    @property
+    def server_config(self) -> ServerConfig:
+        if self._server_config is None:
+            self._server_config = ServerConfig.for_entry(self.entry)
+        return self._server_config
+
+    def listener_options(self):
+        """challenge-listener.py flags for the settings of server.ini"""
+        options = ""
+        for name, value in self.server_config.listener_settings().items():
+            if value:
+                options += f" --{name.replace('_', '-')} {value}"
+        return options
+
     def set_listener_command(self):
-        self.listener_command = f"python3 /usr/local/bin/challenge-listener.py '{self.requires_server_string}' {self.port}"
+        self.listener_command = f"python3 /usr/local/bin/challenge-listener.py{self.listener_options()} '{self.requires_server_string}' {self.port}"
+
+    def listener_entry(self, mode="pty"):
+        """This challenge's row in the listener daemon's table (challenge-listener.py --table)"""
+        entry = {"name": self.name,
+                 "port": self.port,
+                 "command": self.requires_server_string,
+                 "user": self.username,
+                 "mode": mode,
+                 "directory": f"/home/{self.username}",
+                 # changes with server.zip, so a reload restarts the challenge even if nothing else changed
+                 "revision": "%d-%d" % self.entry.files.get("server.zip", (0, 0))}
+        entry.update(self.server_config.listener_settings())
+        return entry
 
-    def generate_dockerfile(self, out_path):
+    def generate_dockerfile(self, out_path, base_image=DOCKER_BASE_IMAGE):
+        # Packages and the listener come from the shared base image (see generate_base_dockerfile),
+        # this only adds a thin layer with the challenge's own files
         dockerfile_template = f"""
-                                    FROM "ubuntu"
-                                    COPY install_required_packages.sh /root/install_required_packages.sh
-                                    COPY server.zip /home/{self.username}/server/server.zip 
-                                    COPY requires-server /home/{self.username}/requires-server
-                                    COPY challenge-listener.py /usr/local/bin/challenge-listener.py
-                                    RUN chmod 755 /usr/local/bin/challenge-listener.py 
-                                    RUN apt update
-                                    RUN /root/install_required_packages.sh
+                                    FROM {base_image}
                                     RUN useradd -M -d /home/{self.username} {self.username}
+                                    COPY server.zip /home/{self.username}/server/server.zip
+                                    COPY requires-server /home/{self.username}/requires-server
                                     WORKDIR /home/{self.username}/server
-                                    RUN unzip server.zip 
-                                    RUN chmod -R 755 $(pwd)
-                                    RUN mv * .. 
+                                    RUN unzip server.zip && chmod -R 755 $(pwd) && mv * ..
                                     WORKDIR /home/{self.username}
-                                    CMD {self.listener_command}"""
+                                    CMD python3 /usr/local/bin/challenge-listener.py{self.listener_options()} '{self.requires_server_string}' {DOCKER_CHALLENGE_PORT}"""
 
         dockerfile_template = textwrap.dedent(dockerfile_template)
     
@@ -150,60 +236,121 @@ class Challenge(object):
             f.write(dockerfile_template)
 
 
-def get_challenge_list(directory_list: List[str]) -> List[Challenge]:
-    """ Builds a list of challenge objects from all challenge bundles in args.directory """
+def generate_base_dockerfile(out_path):
+    """Dockerfile of the image every service challenge builds on: packages and challenge-listener.py, built once"""
+    dockerfile_template = """
+                            FROM "ubuntu"
+                            COPY install_required_packages.sh /root/install_required_packages.sh
+                            COPY challenge-listener.py /usr/local/bin/challenge-listener.py
+                            RUN chmod 755 /usr/local/bin/challenge-listener.py
+                            RUN apt update && /root/install_required_packages.sh"""
+
+    dockerfile_template = textwrap.dedent(dockerfile_template)
+
+    if os.path.split(out_path)[1] != "Dockerfile":
+        out_path = os.path.join(out_path, "Dockerfile")
+
+    with open(out_path, "w") as f:
+        f.write(dockerfile_template)
+
+
+def get_challenge_list(index: PackIndex) -> List[Challenge]:
+    """ Builds a list of challenge objects from all challenge bundles in the pack index """
     challenges = []
-    challenge_names = []
-    for challenge_pack in directory_list:
-        problem_dir = os.path.join(os.getcwd(), challenge_pack)
-        category_dirs = [dir for dir in os.listdir(problem_dir) if os.path.isdir(os.path.join(problem_dir, dir)) and not dir.startswith('.')]
-        for category in category_dirs:
-            for challenge in os.listdir(os.path.join(problem_dir, category)):
-                if os.path.isdir(os.path.join(problem_dir, category, challenge)):
-                    chal = Challenge(os.path.join(problem_dir, category, challenge))
-                    if chal.name in challenge_names:
-                        print(f"Two or more challenges named {chal.name}")
-                        # TODO: v2 This is because of the zip file names for challenge.zip not being hash based. This may also be a limitation of CTFd, need to investigate
-                        quit(1)
-                    challenges.append(chal)
-                    challenge_names.append(chal.name)
+    challenge_names = set()
+    for entry in index.challenges:
+        chal = Challenge(entry.directory, entry)
+        if chal.name in challenge_names:
+            print(f"Two or more challenges named {chal.name}")
+            # TODO: v2 This is because of the zip file names for challenge.zip not being hash based. This may also be a limitation of CTFd, need to investigate
+            quit(1)
+        challenges.append(chal)
+        challenge_names.add(chal.name)
     for i in range(len(challenges)):
         challenges[i].id = i + 1
     return challenges
 
 
-def make_challenges(directory_list: List[str], no_make_clean=False):
-    """For every challenge in the given packs that have Makefiles, run `make clean; make`"""
-    for challenge_pack in directory_list:
-        problem_dir = os.path.join(os.getcwd(), challenge_pack)
-        category_dirs = [dir for dir in os.listdir(problem_dir) if os.path.isdir(os.path.join(problem_dir, dir)) and not dir.startswith('.')]
-        for category in category_dirs:
-            for challenge in os.listdir(os.path.join(problem_dir, category)):
-                if os.path.isdir(f'{problem_dir}/{category}/{challenge}') and os.path.exists(f'{problem_dir}/{category}/{challenge}/Makefile'):
-                    if not no_make_clean:
-                        os.system(f'make clean -s -C "{problem_dir}/{category}/{challenge}"')
-                    os.system(f'make -s -C "{problem_dir}/{category}/{challenge}"')
-    return
+def _profile_make(profiler, name, index: PackIndex, results: List[MakeResult]):
+    if profiler is not None:
+        display_paths = {entry.directory: entry.display_path for entry in index.challenges}
+        for result in results:
+            profiler.record(name, result.start, result.duration, challenge=display_paths.get(result.directory, result.directory))
 
 
-def make_clean_challenges(directory_list: List[str]):
+def make_challenges(index: PackIndex, no_make_clean=False, jobs=1, log_dir=DEFAULT_LOG_DIR, cache=None, profiler=None,
+                    directories=None) -> List[MakeResult]:
+    """For every challenge in the given packs that have Makefiles, run `make clean; make`. Returns the failed jobs
+    With a BuildCache, challenges whose contents are unchanged since their last successful make are skipped.
+    directories limits make to those challenge directories of the index"""
+    makefile_dirs = index.makefile_dirs()
+    if directories is not None:
+        makefile_dirs = [directory for directory in makefile_dirs if directory in directories]
+    if cache is not None:
+        stale_dirs = [directory for directory in makefile_dirs if not cache.is_built(directory)]
+        if len(stale_dirs) < len(makefile_dirs):
+            log_normal(f"make: {len(makefile_dirs) - len(stale_dirs)} challenges unchanged since their last build, skipping")
+        makefile_dirs = stale_dirs
+    results = run_make_jobs(makefile_dirs, clean=not no_make_clean, jobs=jobs, log_dir=log_dir)
+    index.refresh(makefile_dirs)
+    _profile_make(profiler, "make", index, results)
+    if cache is not None:
+        for result in results:
+            if not result.failed:
+                cache.mark_built(result.directory)
+    return report_make_results(results)
+
+
+def make_clean_challenges(index: PackIndex, jobs=1, log_dir=DEFAULT_LOG_DIR, profiler=None) -> List[MakeResult]:
     """For every challenge in the given packs that have Makefiles, run `make clean`"""
-    for challenge_pack in directory_list:
-        problem_dir = os.path.join(os.getcwd(), challenge_pack)
-        category_dirs = [dir for dir in os.listdir(problem_dir) if os.path.isdir(os.path.join(problem_dir, dir)) and not dir.startswith('.')]
-        for category in category_dirs:
-            for challenge in os.listdir(os.path.join(problem_dir, category)):
-                if os.path.isdir(f'{problem_dir}/{category}/{challenge}') and os.path.exists(f'{problem_dir}/{category}/{challenge}/Makefile'):
-                    os.system(f'make clean -s -C "{problem_dir}/{category}/{challenge}"')
-    return
-
-
-def get_flag_list(challenges: List[Challenge]):
-    """Builds a list of objects from challenges that dump nicely into json for CTFd """
-    challenge_flag_list = []
-    challenge_flag_list = [chal.ctfd_flag_repr() for chal in challenges]
-    challenge_flag_list = [flag for flag in challenge_flag_list if flag is not None]
-    for i in range(len(challenge_flag_list)):
-        challenge_flag_list[i].id = i + 1
-    return challenge_flag_list
+    makefile_dirs = index.makefile_dirs()
+    results = run_make_jobs(makefile_dirs, build=False, jobs=jobs, log_dir=log_dir)
+    index.refresh(makefile_dirs)
+    _profile_make(profiler, "make clean", index, results)
+    return report_make_results(results)
+
+
+def dedupe_uploads(challenges: List[Challenge], digest=sha256_of) -> int:
+    """
+    Points challenges that ship byte-identical challenge.zip files at a single upload so the blob is
+    only stored once in the export. Only files whose size collides with another upload get hashed.
+    Returns how many uploads were folded into another.
+    """
+    by_size = defaultdict(list)
+    for chal in challenges:
+        if chal.has_challenge_zip:
+            by_size[chal.entry.files["challenge.zip"][0]].append(chal)
+
+    deduped = 0
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+        first_by_digest = dict()
+        for chal in same_size:
+            first = first_by_digest.setdefault(digest(os.path.join(chal.directory, "challenge.zip")), chal)
+            if first is not chal:
+                chal.upload_location = first.upload_location
+                deduped += 1
+    return deduped
+
+
+def iter_ctfd_flags(challenges: Iterable[Challenge]) -> Iterator[_flag_rep]:
+    """Yields flag rows that dump nicely into json for CTFd, numbered as they are produced"""
+    flag_id = 0
+    for chal in challenges:
+        flag = chal.ctfd_flag_repr()
+        if flag is not None:
+            flag_id += 1
+            flag.id = flag_id
+            yield flag
+
 
+def iter_ctfd_files(challenges: Iterable[Challenge]) -> Iterator[_file_rep]:
+    """Yields a file row for every challenge with a challenge.zip, numbered as they are produced"""
+    file_id = 0
+    for chal in challenges:
+        file = chal.ctfd_file_list()
+        if file is not None:
+            file_id += 1
+            file.id = file_id
+            yield file
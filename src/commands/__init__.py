@@ -1,6 +1,8 @@
 import argparse
 
 from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from importlib import import_module
 
 class BaseCommand(ABC):
     # inspired by pip
@@ -36,16 +38,34 @@ class BaseCommand(ABC):
             return self(argline)
 
 
-# Derive all commands and names from package automatically
-# current way annoying but necessary without abusing the language
-from src.commands.build import Buildcmd
-from src.commands.validate import Validatecmd
+# Commands are imported only once they're selected, so `ctf-tool.py <command>` doesn't pay for the
+# imports of every other command. name -> (module, class, hidden)
+command_registry = {
+    "bench": ("src.commands.bench", "Benchcmd", True),
+    "build": ("src.commands.build", "Buildcmd", False),
+    "loadtest": ("src.commands.loadtest", "Loadtestcmd", False),
+    "status": ("src.commands.status", "Statuscmd", False),
+    "validate": ("src.commands.validate", "Validatecmd", False),
+    "watch": ("src.commands.watch", "Watchcmd", False),
+}
 
-command_list = [
-    Buildcmd,
-    Validatecmd
-]
 
-command_dict = dict()
-for cmd in command_list:
-    command_dict[cmd.name]=cmd
\ No newline at end of file
+class _CommandDict(Mapping):
+    """name -> command class, importing the command's module on first lookup"""
+    def __getitem__(self, name):
+        module, cls, _ = command_registry[name]
+        return getattr(import_module(module), cls)
+
+    def __iter__(self):
+        return iter(command_registry)
+
+    def __len__(self):
+        return len(command_registry)
+
+
+command_dict = _CommandDict()
+
+
+def visible_commands():
+    """Names of the commands listed in the usage, hidden ones can still be run"""
+    return [name for name, (_, _, hidden) in command_registry.items() if not hidden]
@@ -0,0 +1,155 @@
+import argparse
+import json
+
+# "Common" code
+from src.bench import DEFAULT_SIZES, compare_results, generate_pack, heaviest_imports, run_bench, save_results, startup_time
+from src.commands import BaseCommand, command_registry
+from src.tui import log_error, log_normal, log_success, print_object_table
+
+
+def _generator_arguments(parser):
+    parser.add_argument("--categories", type=int, default=10, help="Categories to spread challenges over (default 10)")
+    parser.add_argument("--makefile-share", type=float, default=0.1,
+                        help="Fraction of challenges with a Makefile (default 0.1)")
+    parser.add_argument("--server-share", type=float, default=0.1,
+                        help="Fraction of challenges with requires-server and server.zip (default 0.1)")
+    parser.add_argument("--zip-size", type=int, default=4096, help="Bytes in every challenge.zip (default 4096)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator, same seed same pack")
+
+
+def _generator_kwargs(args):
+    return {"categories": args.categories, "makefile_share": args.makefile_share,
+            "server_share": args.server_share, "zip_size": args.zip_size, "seed": args.seed}
+
+
+class Benchcmd(BaseCommand):
+    name = 'bench'
+    description = ('Benchmark the build pipeline on synthetic challenge packs')
+    hidden = True
+
+    def __init__(self):
+        super().__init__()
+
+    def do_generate(self, argline):
+        parser = argparse.ArgumentParser(prog="bench generate", description="Generate a synthetic challenge pack")
+        parser.add_argument("directory", help="Where to write the pack")
+        parser.add_argument("-n", "--challenges", type=int, default=100, help="Number of challenges (default 100)")
+        _generator_arguments(parser)
+        args = parser.parse_args(argline)
+
+        counts = generate_pack(args.directory, args.challenges, **_generator_kwargs(args))
+        log_success(f"Generated {counts['challenges']} challenges in {args.directory}, "
+                    f"{counts['makefiles']} with Makefiles and {counts['servers']} with requires-server")
+
+    def do_run(self, argline):
+        parser = argparse.ArgumentParser(prog="bench run",
+                                         description="Time every stage of validate and build across pack sizes")
+        parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                            help="Comma separated numbers of challenges (default %(default)s)")
+        parser.add_argument("-j", "--jobs", type=int, default=1, help="--jobs given to validate and build")
+        parser.add_argument("--warm", action="store_true", default=False,
+                            help="Time runs against a primed output/.cache instead of with --no-cache")
+        parser.add_argument("-o", "--output", help="Results file (default output/bench/bench-<time>.json)")
+        parser.add_argument("--compare", help="Earlier results file to compare against")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="--compare: slowdown that counts as a regression (default 0.2 = 20%%)")
+        _generator_arguments(parser)
+        args = parser.parse_args(argline)
+
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = run_bench(sizes, jobs=args.jobs, warm=args.warm, **_generator_kwargs(args))
+        path = save_results(results, args.output)
+        print_object_table([RunRow(run) for run in results["runs"]], align_left=['size', 'command'])
+        log_success(f"Saved results to {path}")
+
+        if args.compare is not None:
+            with open(args.compare) as f:
+                return report_comparison(json.load(f), results, args.threshold)
+        return 0
+
+    def do_compare(self, argline):
+        parser = argparse.ArgumentParser(prog="bench compare", description="Compare two results files")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="Slowdown that counts as a regression (default 0.2 = 20%%)")
+        args = parser.parse_args(argline)
+
+        with open(args.old) as old, open(args.new) as new:
+            return report_comparison(json.load(old), json.load(new), args.threshold)
+
+    def do_startup(self, argline):
+        parser = argparse.ArgumentParser(prog="bench startup",
+                                         description="Time `ctf-tool.py <command> --help` and list its slowest imports")
+        parser.add_argument("commands", nargs="*", help="Commands to time (default all)")
+        parser.add_argument("-n", "--runs", type=int, default=10, help="Runs per command, the median is reported (default 10)")
+        parser.add_argument("--imports", type=int, default=5, help="Slowest imports to list per command (default 5)")
+        parser.add_argument("--max-ms", type=float, help="Fail if any command takes longer than this to start")
+        args = parser.parse_args(argline)
+
+        commands = args.commands or list(command_registry)
+        for command in commands:
+            if command not in command_registry:
+                log_error(f"Unknown command {command}")
+                return 1
+
+        rows = [StartupRow(command, startup_time(command, args.runs), heaviest_imports(command, args.imports))
+                for command in commands]
+        print_object_table(rows, align_left=['command'])
+
+        if args.max_ms is not None:
+            slow = [row.command for row in rows if row._seconds * 1000 > args.max_ms]
+            if slow:
+                log_error(f"{', '.join(slow)} take longer than {args.max_ms:g}ms to start")
+                return 1
+            log_normal(f"Every command starts within {args.max_ms:g}ms")
+        return 0
+
+
+# Stages shorter than this are noise, never reported as regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def report_comparison(old, new, threshold):
+    """Prints every stage's change, returns 1 if any stage regressed by more than threshold"""
+    changes = compare_results(old, new)
+    if not changes:
+        log_error("The results have no runs in common")
+        return 1
+    print_object_table([ChangeRow(change, threshold) for change in changes], align_left=['size', 'command'])
+    regressions = [change for change in changes if change.regressed(threshold, MIN_REGRESSION_SECONDS)]
+    if regressions:
+        log_error(f"{len(regressions)} stages are more than {threshold:.0%} slower")
+        return 1
+    log_normal(f"No stage is more than {threshold:.0%} slower")
+    return 0
+
+
+class RunRow(object):
+    def __init__(self, run):
+        self.size = run["size"]
+        self.command = run["command"]
+        self.cache = run["cache"]
+        self.seconds = f"{run['seconds']:.3f}"
+        self.failed = run["failed"]
+        self.stages = " ".join(f"{stage}={seconds:.3f}" for stage, seconds in run["stages"].items()) or "-"
+
+
+class ChangeRow(object):
+    def __init__(self, change, threshold):
+        self.size = change.size
+        self.command = change.command
+        self.cache = change.cache
+        self.stage = change.stage
+        self.old = f"{change.old:.3f}"
+        self.new = f"{change.new:.3f}"
+        self.change = f"{change.ratio - 1:+.0%}" if change.old else "new"
+        self.regressed = change.regressed(threshold, MIN_REGRESSION_SECONDS)
+
+
+class StartupRow(object):
+    def __init__(self, command, seconds, imports):
+        self.command = command
+        self._seconds = seconds
+        self.ms = f"{seconds * 1000:.0f}"
+        self.imports = " ".join(f"{module}={seconds * 1000:.0f}ms" for module, seconds in imports) or "-"
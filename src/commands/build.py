@@ -1,24 +1,32 @@
 import argparse
+import contextlib
 import os
+import pwd
+import subprocess
 import time
 from typing import List
 import json
 import re
 import shutil
-import uuid
 import zipfile
-import tempfile
-import pickle
 import shlex
 import textwrap
 
 
 # "Common" code
-from src.challenge import Challenge, get_challenge_list, get_flag_list, make_challenges
+from src.cache import CACHE_DIR, BlobStore, BuildCache, sha256_of, stage_file
+from src.challenge import DOCKER_BASE_IMAGE, DOCKER_CHALLENGE_PORT, Challenge, dedupe_uploads, generate_base_dockerfile, get_challenge_list, iter_ctfd_files, iter_ctfd_flags, make_challenges
 from src.commands import BaseCommand
 from src.commands.validate import validate_ctf_directory
-from src.util import EmptyConfigFileError
-from src.tui import log_error, log_success, log_warn, log_normal
+from src.containers import ENGINES, ContainerSpec, ImageSpec, build_images, report_image_builds, run_containers
+from src.export import BaseArchive, CtfdExport
+from src.listener import LISTENER_METRICS_ADDRESS, LISTENER_TABLE_PATH
+from src.pack import PackIndex
+from src.plan import Demand, InventoryError, load_inventory, plan_hosts
+from src.ports import DEFAULT_PORT_RANGE, PortRegistry, parse_port_range, ports_in_use
+from src.profile import Profiler, report_profile
+from src.server_config import SERVER_CONFIG_NAME
+from src.tui import log_error, log_success, log_warn, log_normal, print_object_table
 
 
 class Buildcmd(BaseCommand):
@@ -27,6 +35,7 @@ class Buildcmd(BaseCommand):
 
     def __init__(self):
         super().__init__()
+        self.profiler = Profiler()
 
     def subparser(self):
         return None # overwrites do_x checking and uses __call__ instead
@@ -48,6 +57,36 @@ class Buildcmd(BaseCommand):
         _install_group.add_argument("--install-cron", action="store_true", help="Install ctf services as cron")
         _install_group.add_argument("--install-service", action="store_true", help="Install service challenges as services")
         _install_group.add_argument("--install-docker", action='store_true', help="Install service challenges through docker")
+        _install_group.add_argument("--install-listener", action='store_true', help="Install service challenges behind a single listener daemon")
+        _install_group.add_argument("--plan", metavar="INVENTORY", help="Spread service challenges over the hosts of an inventory file and write a deploy bundle per host instead of installing")
+        parser.add_argument("--port-range",
+                            type=parse_port_range,
+                            default=DEFAULT_PORT_RANGE,
+                            help="Ports to give service challenges, FIRST-LAST (default %d-%d). Assignments are kept in output/ports.json" % DEFAULT_PORT_RANGE)
+        parser.add_argument("--socket-activation",
+                            action='store_true',
+                            default=False,
+                            help="--install-service: systemd listens on the ports and starts a challenge per connection (.socket + @.service units)")
+        parser.add_argument("--listener-workers",
+                            type=int,
+                            default=1,
+                            help="--install-listener, --plan: listener processes sharing the challenge ports with SO_REUSEPORT")
+        parser.add_argument("--plan-format",
+                            choices=PLAN_FORMATS,
+                            default="listener",
+                            help="--plan: bundles install a listener daemon (default) or docker compose services")
+        parser.add_argument("--plan-cpu",
+                            type=float,
+                            default=0.1,
+                            help="--plan: CPUs of a challenge without a cpu setting in server.ini (default 0.1)")
+        parser.add_argument("--plan-memory",
+                            type=int,
+                            default=64,
+                            help="--plan: MB of a challenge without a memory setting in server.ini (default 64)")
+        parser.add_argument("--plan-headroom",
+                            type=float,
+                            default=0.1,
+                            help="--plan: fraction of every host's CPU and memory kept free (default 0.1)")
         parser.add_argument("--no-make",
                             action='store_true',
                             default=False,
@@ -56,140 +95,189 @@ class Buildcmd(BaseCommand):
                             action='store_true',
                             default=False,
                             help="Don't run `make clean` but still use make")
+        parser.add_argument("-j", "--jobs",
+                            type=int,
+                            default=1,
+                            help="Number of challenges to run `make` on at once")
+        parser.add_argument("--docker-jobs",
+                            type=int,
+                            default=None,
+                            help="--install-docker: number of images to build at once, defaults to --jobs")
+        parser.add_argument("--container-engine",
+                            choices=sorted(ENGINES),
+                            default="docker",
+                            help="--install-docker: container engine to install with, `fake` only records what would happen")
+        parser.add_argument("--no-cache",
+                            action='store_true',
+                            default=False,
+                            help="Ignore output/.cache, run make on every challenge and re-read --basezip")
+        parser.add_argument("--profile",
+                            action='store_true',
+                            default=False,
+                            help="Print the time spent in every stage and on the slowest challenges")
+        parser.add_argument("--trace",
+                            default=None,
+                            help="--profile: also write a Chrome trace-event JSON file of every stage and challenge")
         args = parser.parse_args(argline)
+        if args.socket_activation and not args.install_service:
+            parser.error("--socket-activation only applies to --install-service")
+
+        # content hashes of challenges from previous builds, and content-addressed copies of staged files
+        cache = None if args.no_cache else BuildCache()
+        blobs = None if cache is None else BlobStore(cache)
+
+        # one scan of every pack, shared by make, validation, challenge construction and server detection
+        with self.profiler.stage("scan"):
+            index = PackIndex(args.directory)
 
         # run make on any challenges with makefiles
         if not args.no_make:
-            log_normal("Running make on challenges")
-            make_challenges(args.directory, args.no_make_clean)
-            log_success("Ran make on challenges")
+            with self.profiler.stage("make"):
+                log_normal("Running make on challenges")
+                make_failures = make_challenges(index, args.no_make_clean, jobs=args.jobs, cache=cache, profiler=self.profiler)
+                if cache is not None:
+                    cache.save()
+                if make_failures:
+                    log_error("make failed for one or more challenges")
+                    quit(1)
+                log_success("Ran make on challenges")
 
         # Validate the problem set
-        if any([validate_ctf_directory(dir) for dir in args.directory]):
+        with self.profiler.stage("validate"):
+            check_list = [validate_ctf_directory(dir, index=index, jobs=args.jobs, cache=cache, profiler=self.profiler) for dir in args.directory]
+            if cache is not None:
+                cache.save()
+        if any(check_list):
             quit(1)
 
         # Search through our challenge directory and build our list of challenge objects
-        challenges = get_challenge_list(args.directory)
-
-        # CTFd
-        # Build the flag list
-        challenge_flag_list = get_flag_list(challenges)
+        with self.profiler.stage("challenges"):
+            challenges = get_challenge_list(index)
 
-        # Build file list (need to copy our files to the temp dir soon too)
-        tempdirname, tempuploaddir, tempdbdir = make_ctfd_output_folder(args.name)
+        # Output directory for anything installation needs on disk
+        tempdirname = make_ctfd_output_folder(args.name)
         log_success("Created output directories")
-        
-        # Copy challenge files into our temp dir
-        for chal in challenges:
-            chal.copy_zip_file_to_temp(tempuploaddir)
-        log_success("Created CTFd uploads")
-
-        # Create CTFd database objects
-        # TODO: can this be done cleaner with sqlalchemy objects?
-        # Assign ID's to challenges (have to be unique)
-        challenge_file_list = [chal.ctfd_file_list() for chal in challenges]
-        challenge_file_list = [file for file in challenge_file_list if file is not None]
-        for i in range(len(challenge_file_list)):
-            challenge_file_list[i].id = i + 1
 
-        # Installation
-        # Add users to local machine (setup challenge host)
-        if any([args.install_cron, args.install_service, args.install_docker]):
-            for challenge in challenges:
-                challenge.requires_server_path = is_server_required(challenge.directory)
-                if challenge.requires_server_path is not None:
-                    # Set vars for challenge objects
-                    # TODO: none of this should be setting challenge objects properties
-                    challenge.username = force_valid_username(challenge.name)
-                    new_user_home = os.path.join("/home/", challenge.username)
-                    challenge.server_zip_path = os.path.join(os.path.split(challenge.requires_server_path)[0], "server.zip")
-                    challenge.crontab_path = os.path.join("/var/spool/cron/crontabs", challenge.username)
-                    challenge.set_requires_server_string()
-                    challenge.set_listener_command()
-            if args.install_docker is True:
-                # Make container build dirs
-                challenges_requiring_server = [challenge for challenge in challenges if challenge.requires_server_path]
-                create_challenge_docker_env(tempdirname, challenges_requiring_server)
-
-                # Create and test client
-                # TODO: will allow remote installs
-                # client = docker.client.DockerClient()
-                # assert client.ping(), "Could not connect to docker engine"
-
-                # Docker-compose build and run
-                # TODO: replace with python docker client for re-use and remote install
-                os.chdir(f"{tempdirname}/dockerenv")
-                assert os.system("docker-compose build && docker-compose up -d") == 0, "Docker Compose Failed"
-                print(os.path.abspath(os.path.dirname(os.getcwd())))
-                # TODO: bad but it needs to work soon
-                os.chdir(os.path.abspath(os.path.dirname(os.getcwd()+"/../../../")))
-                log_success("Built and started docker containers")
-            else:
-                assert os.geteuid() == 0, "You must be root to install cron/service challenges!"
-                for challenge in challenges:
-                    # TODO: v2 make this a factory method with something like challenge.type
-                    if challenge.requires_server_path is not None:
-                        new_user_home = os.path.join("/home/", challenge.username)
-                        try:
-                            install_on_current_machine(challenge, new_user_home, args.address, cron=(args.install_cron==True))
-                        except EmptyConfigFileError:
-                            continue
-                install_listener_script()
+        # Service challenges, written to listeners.json whether or not they are installed (see loadtest)
+        with self.profiler.stage("listeners"):
+            ports = PortRegistry(port_range=args.port_range)
+            prepare_service_challenges(challenges, ports)
+            ports.save()
+            listener_table_path = os.path.join(tempdirname, "listeners.json")
+            write_listener_table(listener_table_path, challenges)
+
+        # Deploy bundles for the hosts of an inventory, nothing is installed here
+        if args.plan is not None:
+            with self.profiler.stage("plan"):
                 try:
-                    install_cron_reboot_persist()
-                except FileExistsError:
-                    pass
-                except FileNotFoundError:
-                    print("/etc/rc.#d folders not present on current system, skipping reboot persistence")
-
-        # Output CTFd jsons
-        with open(f"{tempdbdir}/challenges.json", "w") as chal_json:
-            _json_repr_challenges = [chal.ctfd_repr() for chal in challenges]
-            json.dump(dump_to_ctfd_json(_json_repr_challenges), chal_json)
-            log_success("Created CTFd challenges table")
-
-        with open(f"{tempdbdir}/files.json", "w") as files_json:
-            json.dump(dump_to_ctfd_json(challenge_file_list), files_json)
-            log_success("Created CTFd files table")
-
-        with open(f"{tempdbdir}/flags.json", "w") as flags_json:
-            json.dump(dump_to_ctfd_json(challenge_flag_list), flags_json)
-            log_success("Created CTFd flags table")
-
-        # Make CTFd config zip
-        # unzip existing CTFd meta (we'll use every file that we didn't generate a version of)
-        temp_unzip_dir = os.path.join(tempfile.gettempdir(), str(uuid.uuid4())[-12:])
-        os.makedirs(temp_unzip_dir)
-        base_zip = zipfile.ZipFile(os.path.join(os.getcwd(), args.basezip[0]))
-        base_zip.extractall(path=temp_unzip_dir)
-        log_success("Extracted CTFd config zip")
-
-        # Merge dirs
-        config_files_to_copy = [f for f in os.listdir(os.path.join(temp_unzip_dir, 'db')) if
-                                f not in os.listdir(tempdbdir)]
-        for f in config_files_to_copy:
-            shutil.copy2(os.path.join(temp_unzip_dir, "db", f), os.path.join(tempdbdir, f))
-        shutil.rmtree(temp_unzip_dir)
-        log_success("Merged CTFd config zip with generated files")
+                    hosts = load_inventory(args.plan)
+                except InventoryError as e:
+                    log_error(str(e))
+                    quit(1)
+                demands = [Demand(challenge.name,
+                                  challenge.server_config.cpu or args.plan_cpu,
+                                  challenge.server_config.memory or args.plan_memory,
+                                  challenge)
+                           for challenge in challenges if challenge.requires_server_path is not None]
+                unplaced = plan_hosts(demands, hosts, args.plan_headroom)
+                if unplaced:
+                    log_error(f"{len(unplaced)} service challenges fit on no host of {args.plan}: "
+                              f"{', '.join(demand.name for demand in unplaced)}")
+                    quit(1)
+                plan_path = write_plan_bundles(os.path.join(tempdirname, "plan"), hosts, args.plan_format,
+                                               args.listener_workers, blobs, sha256_of if cache is None else cache.file_digest)
+                print_object_table([PlanRow(host) for host in hosts], align_left=['host'])
+                log_success(f"Wrote deploy bundles for {sum(1 for host in hosts if host.demands)} hosts to {plan_path}")
 
+        # Installation
+        # Add users to local machine (setup challenge host)
+        if any([args.install_cron, args.install_service, args.install_docker, args.install_listener]):
+            with self.profiler.stage("install"):
+                warn_ports_in_use(challenges)
+                if args.install_docker is True:
+                    # Make container build dirs
+                    challenges_requiring_server = [challenge for challenge in challenges if challenge.requires_server_path]
+                    base_image, images, containers = create_challenge_docker_env(
+                        tempdirname, challenges_requiring_server, blobs, sha256_of if cache is None else cache.file_digest)
+
+                    # Build images concurrently, reusing any whose context hasn't changed, then start the containers
+                    # TODO: will allow remote installs
+                    engine = ENGINES[args.container_engine]()
+                    image_builds = build_images(engine, base_image, images, jobs=args.docker_jobs or args.jobs)
+                    for image_build in image_builds:
+                        self.profiler.record("image", image_build.start, image_build.seconds, challenge=image_build.spec.name)
+                    if cache is not None:
+                        cache.save()
+                    if report_image_builds(image_builds) or run_containers(engine, containers):
+                        log_error("Installing docker challenges failed")
+                        quit(1)
+                    log_success("Built and started docker containers")
+                else:
+                    assert os.geteuid() == 0, "You must be root to install cron/service/listener challenges!"
+                    mode = "cron" if args.install_cron else "listener" if args.install_listener else \
+                        "socket" if args.socket_activation else "service"
+                    provision_host(challenges, args.address[0] if args.address else None, mode, profiler=self.profiler)
+                    install_listener_script()
+                    if args.install_listener:
+                        install_listener_daemon(listener_table_path, args.listener_workers)
+                    try:
+                        install_cron_reboot_persist()
+                    except FileExistsError:
+                        pass
+                    except FileNotFoundError:
+                        print("/etc/rc.#d folders not present on current system, skipping reboot persistence")
+
+        # Make CTFd config zip, written in-process and streamed straight from the challenge packs
         output_zip_name = os.path.join(os.getcwd(), "output", f"{args.name}.ctfd.{time.strftime('%Y.%m.%d-%H:%M:%S')}.zip")
-        os.system(f"cd {tempdbdir}/.. && zip {output_zip_name} -r db/ uploads/*/*")
+        with self.profiler.stage("dedupe"):
+            deduped = dedupe_uploads(challenges, sha256_of if cache is None else cache.file_digest)
+            if deduped:
+                log_normal(f"{deduped} challenge.zip uploads are identical to another challenge's, storing them once")
+            if cache is not None:
+                cache.save()
+        with CtfdExport(output_zip_name) as export:
+            with self.profiler.stage("uploads"):
+                for chal in challenges:
+                    with self.profiler.stage("upload", chal.entry.display_path):
+                        chal.add_zip_file_to_export(export)
+            log_success("Created CTFd uploads")
+
+            # Output CTFd jsons, rows are streamed into the zip as they are generated
+            # TODO: can this be done cleaner with sqlalchemy objects?
+            with self.profiler.stage("json"):
+                export.add_table("db/challenges.json", (chal.ctfd_repr() for chal in challenges), count=len(challenges))
+                log_success("Created CTFd challenges table")
+
+                export.add_table("db/files.json", iter_ctfd_files(challenges))
+                log_success("Created CTFd files table")
+
+                export.add_table("db/flags.json", iter_ctfd_flags(challenges))
+                log_success("Created CTFd flags table")
+
+            # existing CTFd meta (we'll use every table that we didn't generate a version of)
+            with self.profiler.stage("basezip"):
+                base = BaseArchive(os.path.join(os.getcwd(), args.basezip[0]), cache_dir=None if args.no_cache else CACHE_DIR)
+                log_success(f"Loaded CTFd config zip{' from cache' if base.from_cache else ''}")
+
+                # Merge
+                export.merge_base(base)
+                log_success("Merged CTFd config zip with generated files")
+            zip_start = time.monotonic()  # closing writes the central directory and moves the zip into place
+        self.profiler.record("zip", zip_start, time.monotonic() - zip_start)
         log_success(f"Created CTFd upload zip as {output_zip_name}")
 
+        if args.profile:
+            report_profile(self.profiler, trace_path=args.trace)
+
 
 # CTFd Util functions
 def make_ctfd_output_folder(ctf_name):
-    """ Builds a temporary output folder to copy challenge data into before zip"""
+    """ Builds the output folder for build files that have to exist on disk (e.g. docker build contexts)"""
     # General
     # TODO: prepend name here
     tempdirname = os.path.join("output", ctf_name + time.strftime(".%Y.%m.%d-%H:%M:%S"))
-    # CTFd
-    tempuploaddir = f"{tempdirname}/ctfd/uploads"
-    tempdbdir = f"{tempdirname}/ctfd/db"
     os.makedirs(tempdirname)
-    os.makedirs(tempuploaddir)
-    os.makedirs(tempdbdir)
-    return tempdirname, tempuploaddir, tempdbdir
+    return tempdirname
 
 
 def output_ctfd_csv(challenges: List[Challenge]): # TODO: unused
@@ -201,39 +289,22 @@ def output_ctfd_csv(challenges: List[Challenge]): # TODO: unused
     chal_file.close()
 
 
-def dump_to_ctfd_json(not_challenges): # TODO: "not_challenges" is confusing
-    chal_dict = dict()
-    chal_dict['count'] = len(not_challenges)
-    chal_dict['results'] = []
-    for c, not_chal in enumerate(not_challenges):
-        chal_dict['results'].append(not_chal.__dict__)
-    chal_dict['meta'] = {}
-    return chal_dict
+def prepare_service_challenges(challenges, ports):
+    """Sets the port, user, paths and commands of every challenge with a requires-server file"""
+    for challenge in challenges:
+        challenge.requires_server_path = challenge.entry.requires_server_path
+        if challenge.requires_server_path is not None:
+            # Set vars for challenge objects
+            # TODO: none of this should be setting challenge objects properties
+            challenge.port = ports.assign(challenge.name)
+            challenge.username = force_valid_username(challenge.name)
+            challenge.server_zip_path = os.path.join(os.path.split(challenge.requires_server_path)[0], "server.zip")
+            challenge.crontab_path = os.path.join("/var/spool/cron/crontabs", challenge.username)
+            challenge.set_requires_server_string()
+            challenge.set_listener_command()
 
 
 # Server challenge installation (cron)
-def setup_listener(challenge: Challenge, cron: bool = False): # TODO: break into smaller functions, this does a lot
-    """sets up listeners"""
-    if challenge.server_zip_path is not None:
-        zip_ref = zipfile.ZipFile(challenge.server_zip_path, "r")
-        unzipped_server_dir = os.path.join(os.path.abspath(os.path.dirname(challenge.server_zip_path)), "server")
-        zip_ref.extractall(unzipped_server_dir)
-        zip_ref.close()
-        copytree(unzipped_server_dir, os.path.split(challenge.server_zip_path)[0])
-        shutil.rmtree(unzipped_server_dir, ignore_errors=True)
-
-    binary_path = get_binary_path_from_requires_server_string(challenge.requires_server_string)
-    # change perms for binary
-    #shutil.chown(binary_path, user="root", group="root")
-    #os.chmod(binary_path, 0o755)
-    if cron:
-        # create crontab
-        create_user_crontab(challenge.crontab_path, challenge.listener_command, challenge.username)
-    else:
-        # create systemd service
-        install_systemd_service(challenge.listener_command, challenge.username)
-
-
 def create_user_crontab(crontab_path, command, username):
     # internal screaming because of cron
     crontab_string = f"@reboot {command}\n"
@@ -255,10 +326,8 @@ def install_cron_reboot_persist():
         os.symlink(new_reboot_persist_path, symlink_path.format(init_no))
 
 
-def install_systemd_service(command, username):
-    """
-        Creates a new service called <username>.service and
-    """
+def systemd_service_unit(command, username):
+    """<username>.service running command as the challenge user"""
     systemd_unitfile = f"""[Unit]
                            Description=Run {command} as user {username}
 
@@ -272,44 +341,232 @@ def install_systemd_service(command, username):
 
                            [Install]
                            WantedBy=multi-user.target"""
-    systemd_unitfile = textwrap.dedent(systemd_unitfile)
-    systemd_unit_path = f"/etc/systemd/system/{username}.service"
-    with open(systemd_unit_path, "w") as f:
-        f.write(systemd_unitfile)
-    os.chmod(systemd_unit_path, 0o644)
-    os.system("systemctl daemon-reload")
-    os.system(f"systemctl enable {username}.service --now")
+    return textwrap.dedent(systemd_unitfile)
 
 
-# Server challenge installation (files)
-def get_binary_path_from_requires_server_string(requires_server_string):
+def socket_activation_units(challenge):
     """
-    Gets the binary to run from the requires-server file. Tries to be smart with interpreters
-    TODO: force shebang lines to simplify this
+    <username>.socket (systemd owns the port, Accept=yes) and <username>@.service, started per
+    connection with the socket as stdin/stdout. server.ini limits map onto the matching systemd settings.
+    Returns {unit name: unit file}.
     """
-    requires_server_args = shlex.split(requires_server_string)
-    if len(requires_server_args) > 1:
-        binary_path = requires_server_args[1]
-    else:
-        binary_path = requires_server_args[0]
+    config = challenge.server_config
+    username = challenge.username
+    socket_options = ""
+    if config.max_sessions:
+        socket_options += f"\nMaxConnections={config.max_sessions}"
+    if config.rate:
+        # MaxConnectionsPerSource= caps concurrent connections and TriggerLimit*= stops the whole socket,
+        # systemd has nothing that limits new connections per minute from a source
+        log_warn(f"{challenge.name}: rate = {config.rate} of {SERVER_CONFIG_NAME} isn't enforced with --socket-activation")
+    service_options = ""
+    if config.session_timeout:
+        service_options += f"\nRuntimeMaxSec={config.session_timeout}"
+    if config.rlimit_cpu:
+        service_options += f"\nLimitCPU={config.rlimit_cpu}"
+    if config.rlimit_as:
+        service_options += f"\nLimitAS={config.rlimit_as * 1024 * 1024}"
+    if config.rlimit_nproc:
+        service_options += f"\nLimitNPROC={config.rlimit_nproc}"
+
+    socket_unitfile = textwrap.dedent(f"""\
+        [Unit]
+        Description=Listen for {username} on port {challenge.port}
+
+        [Socket]
+        ListenStream={challenge.port}
+        Accept=yes""") + socket_options + textwrap.dedent("""
+
+        [Install]
+        WantedBy=sockets.target
+        """)
+    # no pty like the listener gives, unbuffered stdio keeps prompts from sitting in a buffer
+    service_unitfile = textwrap.dedent(f"""\
+        [Unit]
+        Description=Run {challenge.requires_server_string} as user {username} for one connection
+
+        [Service]
+        User={username}
+        WorkingDirectory=/home/{username}
+        Environment=HOME=/home/{username} PYTHONUNBUFFERED=1
+        ExecStart=/usr/bin/stdbuf -i0 -o0 -e0 {challenge.requires_server_string}
+        StandardInput=socket
+        StandardOutput=socket
+        StandardError=socket""") + service_options + "\n"
+    return {f"{username}.socket": socket_unitfile, f"{username}@.service": service_unitfile}
+
+
+def write_systemd_unit(name, unitfile):
+    """Writes a unit to /etc/systemd/system, systemd has to be reloaded (see enable_systemd_units)"""
+    systemd_unit_path = f"/etc/systemd/system/{name}"
+    with open(systemd_unit_path, "w") as f:
+        f.write(unitfile)
+    os.chmod(systemd_unit_path, 0o644)
+
+
+def enable_systemd_units(names):
+    """One daemon-reload and one enable --now for every unit written"""
+    if names:
+        subprocess.run(["systemctl", "daemon-reload"])
+        subprocess.run(["systemctl", "enable", "--now"] + list(names))
 
-    return binary_path
 
+# Server challenge installation (listener daemon)
+def warn_ports_in_use(challenges):
+    """Warns about service challenge ports something on this host is already listening on"""
+    service_challenges = [challenge for challenge in challenges if challenge.port is not None]
+    in_use = set(ports_in_use([challenge.port for challenge in service_challenges]))
+    for challenge in service_challenges:
+        if challenge.port in in_use:
+            log_warn(f"port {challenge.port} of {challenge.name} is already in use on this host, "
+                     "fine if it's an earlier install of the challenge")
+    return in_use
 
-def copytree(src, dst, symlinks=False, ignore=None):
+
+def write_listener_table(path, challenges):
+    """The (port, command, user) table of every service challenge, read by challenge-listener.py --table"""
+    entries = [challenge.listener_entry() for challenge in challenges if challenge.requires_server_string is not None]
+    with open(path, "w") as f:
+        json.dump(entries, f, indent=2)
+    return entries
+
+
+def install_listener_table(table_path):
+    """Puts a listener table where the daemon reads it, replacing the old one in a single rename"""
+    os.makedirs(os.path.dirname(LISTENER_TABLE_PATH), exist_ok=True)
+    shutil.copy2(table_path, LISTENER_TABLE_PATH + ".tmp")
+    os.chmod(LISTENER_TABLE_PATH + ".tmp", 0o644)
+    os.replace(LISTENER_TABLE_PATH + ".tmp", LISTENER_TABLE_PATH)
+
+
+def listener_daemon_unit(workers=1):
+    """ctf-tool-listener.service, serving every challenge of LISTENER_TABLE_PATH"""
+    systemd_unitfile = f"""[Unit]
+                           Description=ctf-tool challenge listener
+                           After=network.target
+
+                           [Service]
+                           Type=exec
+                           ExecStart=/usr/bin/env python3 /usr/local/bin/challenge-listener.py --table {LISTENER_TABLE_PATH} --workers {workers} --metrics {LISTENER_METRICS_ADDRESS}
+                           ExecReload=/bin/kill -HUP $MAINPID
+                           Restart=on-failure
+
+                           [Install]
+                           WantedBy=multi-user.target"""
+    return textwrap.dedent(systemd_unitfile)
+
+
+def install_listener_daemon(table_path, workers=1):
     """
-    Handles the root dir already existing
-    https://stackoverflow.com/questions/1868714/how-do-i-copy-an-entire-directory-of-files-into-an-existing-directory-using-pyth
+    Installs the listener table and a single ctf-tool-listener.service serving every challenge in it.
+    If the daemon is already running it is told to reload the table.
     """
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, symlinks, ignore)
+    install_listener_table(table_path)
+    write_systemd_unit("ctf-tool-listener.service", listener_daemon_unit(workers))
+    enable_systemd_units(["ctf-tool-listener.service"])
+    subprocess.run(["systemctl", "reload-or-restart", "ctf-tool-listener.service"])
+
+
+# Deploy bundles (--plan)
+PLAN_FORMATS = ("listener", "compose")
+
+
+class PlanRow(object):
+    def __init__(self, host):
+        self.host = host.name
+        self.address = host.address
+        self.challenges = len(host.demands)
+        self.cpu = f"{host.used_cpu:g}/{host.cpu:g}"
+        self.memory = f"{host.used_memory}/{host.memory} MB"
+        self.bundle = f"plan/{host.name}" if host.demands else "none, nothing planned"
+
+
+def listener_bundle_script(host, usernames):
+    """install.sh of a listener bundle: challenge users and their files, the listener table and daemon"""
+    users = " ".join(shlex.quote(username) for username in usernames)
+    return textwrap.dedent(f"""\
+        #!/bin/sh
+        # Installs the service challenges planned for {host.name} ({host.address}), written by `ctf-tool.py build --plan`
+        set -e
+        cd "$(dirname "$0")"
+        [ "$(id -u)" = 0 ] || {{ echo "install.sh must be run as root" >&2; exit 1; }}
+
+        for user in {users}; do
+            id -u "$user" >/dev/null 2>&1 || useradd -m "$user"
+            python3 -m zipfile -e "server/$user.zip" "/home/$user"
+            chown -R "root:$user" "/home/$user"
+            chmod -R 550 "/home/$user"
+        done
+
+        install -D -m 755 challenge-listener.py /usr/local/bin/challenge-listener.py
+        install -D -m 644 listeners.json {LISTENER_TABLE_PATH}
+        install -D -m 644 ctf-tool-listener.service /etc/systemd/system/ctf-tool-listener.service
+        systemctl daemon-reload
+        systemctl enable --now ctf-tool-listener.service
+        systemctl reload-or-restart ctf-tool-listener.service
+        """)
+
+
+def compose_bundle_script(host, base_image):
+    """install.sh of a compose bundle: the shared base image, then every challenge container"""
+    return textwrap.dedent(f"""\
+        #!/bin/sh
+        # Starts the service challenges planned for {host.name} ({host.address}), written by `ctf-tool.py build --plan`
+        set -e
+        cd "$(dirname "$0")/dockerenv"
+        docker build -t {base_image.tag} base.image
+        if docker compose version >/dev/null 2>&1; then
+            docker compose up -d --build
+        else
+            docker-compose up -d --build
+        fi
+        """)
+
+
+def write_plan_bundles(path, hosts, plan_format="listener", workers=1, blobs=None, digest=sha256_of):
+    """
+    Writes <path>/<host>/ for every host of a plan: install.sh, the port table (listeners.json) and either
+    the listener daemon with every challenge's server.zip or docker build contexts and a docker-compose.yml.
+    Each bundle only needs to be copied to its host and run there. The nc line of every planned
+    challenge points at its host. Hosts the plan left empty get no bundle, an empty docker-compose.yml
+    is rejected by docker compose. <path>/plan.json records the placement. Returns path.
+    """
+    os.makedirs(path)
+    for host in hosts:
+        if not host.demands:
+            continue
+        host_path = os.path.join(path, host.name)
+        os.mkdir(host_path)
+        challenges = [demand.item for demand in host.demands]
+        for challenge in challenges:
+            challenge.description += f"\n\nnc {host.address} {challenge.port}"
+        write_listener_table(os.path.join(host_path, "listeners.json"), challenges)
+
+        if plan_format == "compose":
+            base_image, _, _ = create_challenge_docker_env(host_path, challenges, blobs, digest)
+            script = compose_bundle_script(host, base_image)
         else:
-            shutil.copy2(s, d)
+            server_path = os.path.join(host_path, "server")
+            os.mkdir(server_path)
+            for challenge in challenges:
+                stage_file(challenge.server_zip_path, os.path.join(server_path, f"{challenge.username}.zip"), blobs)
+            listener_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "..", "scripts", "challenge-listener.py")
+            stage_file(listener_path, host_path, blobs)
+            with open(os.path.join(host_path, "ctf-tool-listener.service"), "w") as f:
+                f.write(listener_daemon_unit(workers))
+            script = listener_bundle_script(host, [challenge.username for challenge in challenges])
+
+        script_path = os.path.join(host_path, "install.sh")
+        with open(script_path, "w") as f:
+            f.write(script)
+        os.chmod(script_path, 0o755)
 
+    with open(os.path.join(path, "plan.json"), "w") as f:
+        json.dump({"format": plan_format, "hosts": [host.as_dict() for host in hosts]}, f, indent=2)
+    return path
 
+
+# Server challenge installation (files)
 def force_valid_username(name):
     """force replace certain special characters with _, force to lowercase,
     truncate username if it is over 30 characters. Some people think they are super clever when
@@ -330,71 +587,87 @@ def install_listener_script():
     os.chmod(new_listener_path, 0o755)
 
 
-def is_server_required(path):
-    requires_server_path = None
-    # find out if user accounts must be made or not
-    for root, dirs, files in os.walk(path):
-        for item in files:
-            if item == "requires-server":
-                requires_server_path = os.path.join(root, item)
-                break
-        if requires_server_path is not None:
-            break
-    return requires_server_path
-
-
-def install_on_current_machine(challenge, new_user_home, address, cron=False):
-    # add user and copy everything to new user's home dir
-    os.system("useradd -m {:s}".format(challenge.username))
-    if not os.path.exists(challenge.server_zip_path):
-        # Directory is missing server.zip, but letting execution continue so that the user is warned
-        challenge.server_zip_path = None
-    else:
-        shutil.copy2(challenge.server_zip_path, new_user_home)
-        challenge.server_zip_path = os.path.join(new_user_home, "server.zip")
-    shutil.copy2(challenge.requires_server_path, new_user_home)
-    challenge.requires_server_path = os.path.join(new_user_home, "requires-server")
-    
-    # I forget what this does
-    required_vars = {"requires_server_path": challenge.requires_server_path,
-                     "server_zip_path": challenge.server_zip_path,
-                     "port": challenge.port,
-                     "crontab_path": challenge.crontab_path,
-                     "username": challenge.username}    
-    
-    empty_required_keys = list()
-    for key in list(required_vars.keys()):
-        if required_vars[key] is None:
-            empty_required_keys.append(key)
-
-    if len(empty_required_keys) > 0:
-        print(f"Challenge listener not set up for challenge: {challenge.name} because the following "
-              "required parameters were not fulfilled:")
-        for i in empty_required_keys:
-            print(f"{i}")
-        print("")
-        return
+def create_users(usernames):
+    """
+    Creates every user (with a home and a group of the same name) that doesn't exist yet in a single
+    newusers run, falling back to one useradd per user where newusers isn't available. Returns the created users.
+    """
+    existing = {user.pw_name for user in pwd.getpwall()}
+    missing = [username for username in dict.fromkeys(usernames) if username not in existing]
+    if not missing:
+        return []
+    # name:password:uid:gid:gecos:home:shell, empty ids are allocated, "!" is a locked password like useradd's
+    batch = "".join(f"{username}:!::::/home/{username}:/bin/sh\n" for username in missing)
     try:
-        # Setup crontab
-        setup_listener(challenge, cron=cron)
-        #os.system(f"chown root:{challenge.username} {new_user_home}/flag.txt")
-        #os.system(f"chmod 020 {new_user_home}/flag.txt")
-        challenge.description += f"\n\nnc {address} {challenge.port}"
-        os.remove(f"{new_user_home}/requires-server")
-        os.remove(f"{new_user_home}/server.zip")
-    except EmptyConfigFileError:
-        print(f"\n\nThe requires-server file for the challenge: {challenge.username} is empty, "
-              f"skipping listener setup for that challenge")
-        raise EmptyConfigFileError
-    
-    # Set permissions on user dir (root:challenge_user -rx-rx---)
-    # TODO: use the python equivalent although this is pretty much universal
-    os.system(f"chown -R root:{challenge.username} {new_user_home}") 
-    os.system(f"chmod -R 550 {new_user_home}")
+        subprocess.run(["newusers", "--crypt-method", "NONE"], input=batch.encode(),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        pass
+    existing = {user.pw_name for user in pwd.getpwall()}
+    for username in missing:
+        if username not in existing:
+            subprocess.run(["useradd", "-m", username])
+    return missing
+
+
+def set_home_permissions(home, gid):
+    """root:<challenge user> and r-xr-x--- on the home and everything in it, without following symlinks"""
+    os.chown(home, 0, gid)
+    os.chmod(home, 0o550)
+    with os.scandir(home) as it:
+        for item in it:
+            os.chown(item.path, 0, gid, follow_symlinks=False)
+            if item.is_symlink():
+                continue
+            os.chmod(item.path, 0o550)
+            if item.is_dir():
+                set_home_permissions(item.path, gid)
+
+
+def provision_host(challenges, address, mode="service", profiler=None):
+    """
+    Installs every service challenge onto the current machine in batches: users are created in one
+    pass, server.zip is extracted straight into each home, and for mode "service" every unit is
+    written before systemd is reloaded once. mode "socket" does the same with socket activated
+    units (see socket_activation_units), mode "cron" writes crontabs instead and "listener" leaves
+    serving to the listener daemon (see install_listener_daemon).
+    """
+    installs = [challenge for challenge in challenges if challenge.requires_server_path is not None]
+    create_users([challenge.username for challenge in installs])
+
+    units = []
+    for challenge in installs:
+        with profiler.stage("install", challenge.entry.display_path) if profiler is not None else contextlib.suppress():
+            new_user_home = os.path.join("/home/", challenge.username)
+            if challenge.server_zip_path is None or not os.path.exists(challenge.server_zip_path):
+                print(f"Challenge listener not set up for challenge: {challenge.name} because it has no server.zip\n")
+                continue
+            with zipfile.ZipFile(challenge.server_zip_path) as server_zip:
+                server_zip.extractall(new_user_home)
+
+            if mode == "cron":
+                create_user_crontab(challenge.crontab_path, challenge.listener_command, challenge.username)
+            elif mode == "service":
+                write_systemd_unit(f"{challenge.username}.service", systemd_service_unit(challenge.listener_command, challenge.username))
+                units.append(f"{challenge.username}.service")
+            elif mode == "socket":
+                for name, unitfile in socket_activation_units(challenge).items():
+                    write_systemd_unit(name, unitfile)
+                units.append(f"{challenge.username}.socket")
+            challenge.description += f"\n\nnc {address} {challenge.port}"
+
+            set_home_permissions(new_user_home, pwd.getpwnam(challenge.username).pw_gid)
+
+    enable_systemd_units(units)
 
 
 # Docker challenge installation
-def create_challenge_docker_env(path, challenges):
+def create_challenge_docker_env(path, challenges, blobs=None, digest=sha256_of):
+    """
+    Writes the build contexts for the shared base image and every challenge image, plus a
+    docker-compose.yml equivalent for running them by hand. Returns the base ImageSpec, the
+    challenge ImageSpecs and the ContainerSpecs to run.
+    """
     docker_compose_str = "version: '3.3'\nservices:\n"
     dockerenv_path = os.path.join(path, "dockerenv")
     listener_script_path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
@@ -406,27 +679,41 @@ def create_challenge_docker_env(path, challenges):
                                                 "scripts",
                                                 "install_required_packages.sh")
     os.mkdir(dockerenv_path)
+
+    # shared base image, the only context with the package script and listener
+    base_docker_path = os.path.join(dockerenv_path, "base.image")  # "." never appears in usernames
+    os.mkdir(base_docker_path)
+    # context file -> where it was staged from, hashed there (see context_hash)
+    base_sources = {os.path.basename(stage_file(source, base_docker_path, blobs)): source
+                    for source in (listener_script_path, required_package_script_path)}
+    generate_base_dockerfile(base_docker_path)
+    base_image = ImageSpec("base.image", base_docker_path, DOCKER_BASE_IMAGE, digest, base_sources)
+
+    images = []
+    containers = []
     # yaml is anti tabs
     t = "    "
     for challenge in challenges:
         challenge_docker_path = os.path.join(dockerenv_path, challenge.username)
         os.mkdir(challenge_docker_path)
-        # TODO: needs cleaned up
-        try:
-            shutil.copy2(listener_script_path, challenge_docker_path)
-            shutil.copy2(required_package_script_path, challenge_docker_path)
-            shutil.copy2(challenge.server_zip_path, challenge_docker_path)
-            shutil.copy2(challenge.requires_server_path, challenge_docker_path)
-        except Exception:
-            raise
-        challenge.generate_dockerfile(challenge_docker_path)
+        # build contexts are only read, identical files are hardlinks to one blob
+        sources = {os.path.basename(stage_file(source, challenge_docker_path, blobs)): source
+                   for source in (challenge.server_zip_path, challenge.requires_server_path)}
+        challenge.generate_dockerfile(challenge_docker_path, base_image=base_image.tag)
+        image = ImageSpec(challenge.username, challenge_docker_path, f"ctf-tool/{challenge.username}", digest, sources)
+        images.append(image)
+        containers.append(ContainerSpec(f"ctf-tool-{challenge.username}", image.tag, challenge.username,
+                                        [(challenge.port, DOCKER_CHALLENGE_PORT)]))
         docker_compose_str += f"{t}{challenge.username}:\n"
         docker_compose_str += f"{t}{t}build: '{challenge.username}/.'\n"
+        docker_compose_str += f"{t}{t}image: '{image.tag}'\n"
         docker_compose_str += f"{t}{t}user: '{challenge.username}'\n"
         docker_compose_str += f"{t}{t}tty: true\n"
         docker_compose_str += f"{t}{t}ports:\n"
-        docker_compose_str += f"{t}{t} - '{challenge.port}:{challenge.port}'\n"
+        docker_compose_str += f"{t}{t} - '{challenge.port}:{DOCKER_CHALLENGE_PORT}'\n"
 
     docker_compose_path = os.path.join(dockerenv_path, "docker-compose.yml")
     with open(docker_compose_path, "w") as f:
         f.write(docker_compose_str)
+
+    return base_image, images, containers
@@ -0,0 +1,121 @@
+import argparse
+import glob
+import json
+import os
+from typing import List
+
+
+# "Common" code
+from src.commands import BaseCommand
+from src.loadtest import LoadTarget, run_loadtest
+from src.tui import log_error, log_normal, print_object_table
+
+
+class Loadtestcmd(BaseCommand):
+    name = 'loadtest'
+    description = ('Load test the service challenges of a build')
+
+    def __init__(self):
+        super().__init__()
+
+    def subparser(self):
+        return None # overwrites do_x checking and uses __call__ instead
+
+    def __call__(self, argline):
+        parser = argparse.ArgumentParser(description=self.description)
+        parser.add_argument("table",
+                            nargs="?",
+                            help="listeners.json of a build, or its output folder (default: the newest build in output/)")
+        parser.add_argument("--host",
+                            default="127.0.0.1",
+                            help="Host the challenges are served on (default 127.0.0.1)")
+        parser.add_argument("--challenge",
+                            action="append",
+                            help="Only load this challenge, can be given more than once")
+        parser.add_argument("-n", "--connections",
+                            type=int,
+                            default=100,
+                            help="Sessions to run against each challenge (default 100)")
+        parser.add_argument("-c", "--concurrency",
+                            type=int,
+                            default=10,
+                            help="Sessions open at once per challenge (default 10)")
+        parser.add_argument("--timeout",
+                            type=float,
+                            default=5.0,
+                            help="Seconds a session may take before it counts as an error (default 5)")
+        parser.add_argument("--script",
+                            help="JSON interaction to run instead of connect, read, close: a list of "
+                                 "{\"send\": text} / {\"expect\": text} steps, or an object of them per challenge name")
+        parser.add_argument("--together",
+                            default=False,
+                            action='store_true',
+                            help="Load every challenge at the same time instead of one after another")
+        parser.add_argument("--json",
+                            default=False,
+                            action='store_true',
+                            help="Print the results as JSON instead of a table")
+        args = parser.parse_args(argline)
+
+        table_path = find_listener_table(args.table)
+        if table_path is None:
+            log_error("No listeners.json found, build a pack with service challenges first or give its path")
+            return 1
+        scripts = None
+        if args.script is not None:
+            with open(args.script) as f:
+                scripts = json.load(f)
+        targets = load_targets(table_path, args.host, args.challenge, scripts)
+        if not targets:
+            log_error(f"No challenges to load in {table_path}")
+            return 1
+
+        if not args.json:
+            log_normal(f"Loading {len(targets)} challenges from {table_path}: {args.connections} sessions each, {args.concurrency} at a time")
+        results = run_loadtest(targets, args.connections, args.concurrency, args.timeout, args.together)
+
+        if args.json:
+            print(json.dumps([result.as_dict() for result in results], indent=2))
+        else:
+            print_object_table([LoadRow(result) for result in results], align_left=['name', 'port'])
+        return 0
+
+
+def find_listener_table(path=None):
+    """listeners.json from a path to it or to a build output folder, else from the newest build in output/"""
+    if path is None:
+        tables = glob.glob(os.path.join("output", "*", "listeners.json"))
+        return max(tables, key=os.path.getmtime) if tables else None
+    if os.path.isdir(path):
+        path = os.path.join(path, "listeners.json")
+    return path if os.path.isfile(path) else None
+
+
+def load_targets(table_path, host, names=None, scripts=None) -> List[LoadTarget]:
+    with open(table_path) as f:
+        entries = json.load(f)
+    targets = []
+    for entry in entries:
+        if names and entry["name"] not in names:
+            continue
+        steps = scripts.get(entry["name"]) if isinstance(scripts, dict) else scripts
+        targets.append(LoadTarget(entry["name"], host, entry["port"], steps))
+    return targets
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+class LoadRow(object):
+    """One row of the results table"""
+    def __init__(self, result):
+        summary = result.as_dict()
+        self.name = summary["name"]
+        self.port = summary["port"]
+        self.sessions = summary["sessions"]
+        self.conn_per_s = f"{summary['connections_per_second']:.1f}"
+        self.p50_ms = _ms(summary["p50_seconds"])
+        self.p99_ms = _ms(summary["p99_seconds"])
+        self.error_rate = f"{summary['error_rate'] * 100:.1f}%"
+        self.errors = " ".join(f"{kind}:{count}" for kind, count in sorted(summary["errors"].items())) or "-"
@@ -0,0 +1,114 @@
+import argparse
+import json
+from collections import Counter
+from typing import List
+
+
+# "Common" code
+from src.commands import BaseCommand
+from src.listener import LISTENER_METRICS_ADDRESS
+from src.tui import log_error, print_object_table
+
+
+class Statuscmd(BaseCommand):
+    name = 'status'
+    description = ('Show live metrics of the installed challenge listener')
+
+    def __init__(self):
+        super().__init__()
+
+    def subparser(self):
+        return None # overwrites do_x checking and uses __call__ instead
+
+    def __call__(self, argline):
+        parser = argparse.ArgumentParser(description=self.description)
+        parser.add_argument("--metrics",
+                            metavar="HOST:PORT",
+                            default=LISTENER_METRICS_ADDRESS,
+                            help=f"Metrics endpoint of the listener (default {LISTENER_METRICS_ADDRESS})")
+        parser.add_argument("--workers",
+                            type=int,
+                            default=1,
+                            help="Listener workers to collect from, worker n serves on the metrics port + n (default 1)")
+        parser.add_argument("--json",
+                            default=False,
+                            action='store_true',
+                            help="Print the merged metrics as JSON instead of a table")
+        args = parser.parse_args(argline)
+
+        try:
+            challenges = merge_metrics([fetch_metrics(url) for url in metrics_urls(args.metrics, args.workers)])
+        except (OSError, ValueError) as e:  # URLError is an OSError
+            log_error(f"Can't read listener metrics from {args.metrics}: {e}")
+            return 1
+
+        if args.json:
+            print(json.dumps(challenges, indent=2))
+        else:
+            print_object_table([ChallengeStatus(challenge) for challenge in challenges], align_left=['name', 'port'])
+        return 0
+
+
+def metrics_urls(address, workers=1) -> List[str]:
+    host, _, port = address.rpartition(":")
+    return [f"http://{host or '127.0.0.1'}:{int(port) + worker}/metrics.json" for worker in range(max(1, workers))]
+
+
+def fetch_metrics(url, timeout=5):
+    import urllib.request  # only status reads over HTTP, don't slow down its --help
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _merge_histograms(a, b):
+    return {"buckets": [[bound, count_a + count_b] for (bound, count_a), (_, count_b) in zip(a["buckets"], b["buckets"])],
+            "sum": a["sum"] + b["sum"],
+            "count": a["count"] + b["count"]}
+
+
+def merge_metrics(documents) -> List[dict]:
+    """Sums the per challenge metrics of every worker's /metrics.json"""
+    merged = dict()  # (name, port) -> challenge metrics
+    for document in documents:
+        for challenge in document["challenges"]:
+            key = (challenge["name"], challenge["port"])
+            if key not in merged:
+                merged[key] = challenge
+                continue
+            total = merged[key]
+            for counter in ("active", "connections", "connections_per_second", "rejected", "timeouts"):
+                total[counter] += challenge[counter]
+            for histogram in ("spawn_seconds", "session_seconds"):
+                total[histogram] = _merge_histograms(total[histogram], challenge[histogram])
+            total["exit_codes"] = dict(Counter(total["exit_codes"]) + Counter(challenge["exit_codes"]))
+    return sorted(merged.values(), key=lambda challenge: challenge["port"])
+
+
+def histogram_quantile(histogram, quantile):
+    """Upper bound of the bucket the quantile falls in, None without observations"""
+    if not histogram["count"]:
+        return None
+    for bound, count in histogram["buckets"]:
+        if count >= quantile * histogram["count"]:
+            return bound
+    return float("inf")
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:g}"
+
+
+class ChallengeStatus(object):
+    """One row of the status table"""
+    def __init__(self, challenge):
+        self.name = challenge["name"]
+        self.port = challenge["port"]
+        self.active = challenge["active"]
+        self.conn_per_s = f"{challenge['connections_per_second']:.2f}"
+        self.connections = challenge["connections"]
+        self.rejected = challenge["rejected"]
+        self.timeouts = challenge["timeouts"]
+        self.spawn_p95_ms = _ms(histogram_quantile(challenge["spawn_seconds"], 0.95))
+        sessions = challenge["session_seconds"]
+        self.session_avg_s = f"{sessions['sum'] / sessions['count']:.2f}" if sessions["count"] else "-"
+        self.exits = " ".join(f"{code}:{count}" for code, count in sorted(challenge["exit_codes"].items())) or "-"
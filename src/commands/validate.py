@@ -1,14 +1,23 @@
 import argparse
-import os
+import contextlib
+import json
 import sys
-import argparse
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 
 # "Common" code
+from src.archive import DEFAULT_MAX_ARCHIVE_SIZE, DEFAULT_MAX_RATIO, VERIFIER_VERSION, throughput, verify_archives
+from src.cache import BuildCache
 from src.commands import BaseCommand
+from src.util import contents_of
 from src.tui import log_error, log_success, log_warn, log_normal
 from src.challenge import make_challenges, make_clean_challenges
+from src.pack import PackIndex
+from src.profile import Profiler, report_profile
+from src.server_config import SERVER_CONFIG_NAME, ServerConfig, ServerConfigError
 
 
 class Validatecmd(BaseCommand):
@@ -17,6 +26,7 @@ class Validatecmd(BaseCommand):
 
     def __init__(self):
         super().__init__()
+        self.profiler = Profiler()
 
     def subparser(self):
         return None
@@ -32,67 +42,268 @@ class Validatecmd(BaseCommand):
                             default=False,
                             action='store_true',
                             help="Don't run `make clean; make` for challenges with Makefiles")
+        parser.add_argument("-j", "--jobs",
+                            type=int,
+                            default=1,
+                            help="Number of challenges to run `make` on and validate at once")
+        parser.add_argument("--no-cache",
+                            action='store_true',
+                            default=False,
+                            help="Re-check every challenge instead of reusing results for unchanged ones from output/.cache")
+        parser.add_argument("--deep",
+                            action='store_true',
+                            default=False,
+                            help="Also stream every member of every challenge.zip/server.zip through a CRC check")
+        parser.add_argument("--max-archive-size",
+                            type=int,
+                            default=DEFAULT_MAX_ARCHIVE_SIZE // (1024 * 1024),
+                            help="--deep: largest uncompressed size of an archive in MB")
+        parser.add_argument("--max-ratio",
+                            type=int,
+                            default=DEFAULT_MAX_RATIO,
+                            help="--deep: compression ratio over which a member is treated as a zip bomb")
+        parser.add_argument("--report",
+                            choices=["text", "json"],
+                            default="text",
+                            help="Output format of the findings, json is meant for CI")
+        parser.add_argument("--report-file",
+                            default=None,
+                            help="Write the report here instead of stdout")
+        parser.add_argument("--profile",
+                            action='store_true',
+                            default=False,
+                            help="Print the time spent in every stage and on the slowest challenges")
+        parser.add_argument("--trace",
+                            default=None,
+                            help="--profile: also write a Chrome trace-event JSON file of every stage and challenge")
         args = parser.parse_args(argline)
 
+        # keep stdout clean for a json report, everything else goes to stderr
+        if args.report == "json" and args.report_file is None:
+            with contextlib.redirect_stdout(sys.stderr):
+                exit_code, report = self.validate(args)
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            exit_code, report = self.validate(args)
+            if args.report == "json":
+                with open(args.report_file, "w") as f:
+                    json.dump(report, f, indent=2)
+        sys.exit(exit_code)
+
+    def validate(self, args):
+        cache = None if args.no_cache else BuildCache()
+
+        # one scan of every pack, shared by make and validation
+        with self.profiler.stage("scan"):
+            index = PackIndex(args.directory)
+
         # make clean; make
+        make_failures = []
         if not args.no_make:
-            make_challenges(args.directory)
+            with self.profiler.stage("make"):
+                make_failures = make_challenges(index, jobs=args.jobs, profiler=self.profiler)
 
         # validate
-        check_list = [validate_ctf_directory(dir, args.verbose) for dir in args.directory]
+        report = {"valid": True, "packs": [], "make_failures": [
+            {"directory": result.directory, "returncode": result.returncode, "log": result.log_path}
+            for result in make_failures]}
+        check_list = []
+        for dir in args.directory:
+            with self.profiler.stage("validate"):
+                findings = validate_pack(dir, index, jobs=args.jobs, cache=cache, profiler=self.profiler)
+            pack_report = {"directory": dir, "challenges": len(index.challenges_in(dir))}
+            if args.deep:
+                with self.profiler.stage("archives"):
+                    deep_findings, pack_report["archives"] = deep_validate_pack(dir, index, args.jobs, cache,
+                                                                                args.max_archive_size * 1024 * 1024,
+                                                                                args.max_ratio, self.profiler)
+                findings += deep_findings
+            check_list.append(report_findings(dir, findings, args.verbose))
+            pack_report["valid"] = not check_list[-1]
+            pack_report["findings"] = [finding.as_dict() for finding in findings]
+            report["packs"].append(pack_report)
+        check_list.append(bool(make_failures))
+        report["valid"] = not any(check_list)
+        if cache is not None:
+            cache.save()
 
         # make clean
         if not args.no_make:
-            make_clean_challenges(args.directory)
+            with self.profiler.stage("make clean"):
+                make_clean_challenges(index, jobs=args.jobs, profiler=self.profiler)
 
-        sys.exit(any(check_list))
-    
+        if args.profile:
+            report_profile(self.profiler, trace_path=args.trace)
 
-def validate_ctf_directory(directory, verbose=False):
-    """Validates the directory structure of a given problem set"""
-    valid_directory = True
-
-    categories = [folder for folder in os.listdir(directory) if os.path.isdir(f"{directory}/{folder}")]
-
-    for category in categories:
-        if category.startswith('.'):
-            continue
-        for challenge in os.listdir(f"{directory}/{category}"):
-            dirname = f"{directory}/{category}/{challenge}"
-            if os.path.isdir(dirname):            
-                fileList = os.listdir(dirname)
-
-                # Standard
-                if "challenge.zip" not in fileList and verbose:
-                    print(f"{dirname}: (optional) challenge.zip missing")
-
-                if "value.txt" not in fileList:
-                    print(f"{dirname}: value.txt missing")
-                    valid_directory = False
-
-                if "message.txt" not in fileList:
-                    print(f"{dirname}: message.txt missing")
-                    valid_directory = False
-
-                if "flag.txt" not in fileList:
-                    print(f"{dirname}: flag.txt missing")
-                    valid_directory = False
-                
-                # Service-req
-                if "requires-server" in fileList:
-                    if "server.zip" not in fileList:
-                        print(f"{dirname}: server.zip missing when requires-server specified")
-                        valid_directory = False
-                    elif open(f"{dirname}/requires-server").read().strip() not in zipfile.ZipFile(f"{dirname}/server.zip").namelist():
-                        print(f"{dirname}: requires-server lists a binary not in server.zip")
-                        valid_directory = False
-                # TODO: v2 Container-req
-
-                # TODO: v2Machine-req
-
-    if not valid_directory:
+        return int(any(check_list)), report
+
+
+class Finding(object):
+    """A problem with one challenge, optional ones are only shown with --verbose"""
+    def __init__(self, challenge, message, optional=False):
+        self.challenge = challenge
+        self.message = message
+        self.optional = optional
+
+    def as_dict(self):
+        return {"challenge": self.challenge, "message": self.message, "optional": self.optional}
+
+    @classmethod
+    def from_dict(cls, finding):
+        return cls(finding["challenge"], finding["message"], finding["optional"])
+
+
+# bump when validate_challenge's checks change, cached findings of other versions are dropped
+VALIDATOR_VERSION = 2
+
+
+def validate_challenge(entry) -> List[Finding]:
+    """Checks a single challenge directory of the pack index"""
+    findings = []
+    dirname = entry.display_path
+
+    # Standard
+    if not entry.has("challenge.zip"):
+        findings.append(Finding(dirname, "(optional) challenge.zip missing", optional=True))
+
+    if not entry.has("value.txt"):
+        findings.append(Finding(dirname, "value.txt missing"))
+
+    if not entry.has("message.txt"):
+        findings.append(Finding(dirname, "message.txt missing"))
+
+    if not entry.has("flag.txt"):
+        findings.append(Finding(dirname, "flag.txt missing"))
+
+    # Service-req
+    if entry.has("requires-server"):
+        if not entry.has("server.zip"):
+            findings.append(Finding(dirname, "server.zip missing when requires-server specified"))
+        elif not server_zip_has(entry.path("server.zip"), contents_of(entry.path("requires-server"))):
+            findings.append(Finding(dirname, "requires-server lists a binary not in server.zip"))
+        if entry.has(SERVER_CONFIG_NAME):
+            try:
+                ServerConfig.for_entry(entry)
+            except ServerConfigError as e:
+                findings.append(Finding(dirname, str(e)))
+    elif entry.has(SERVER_CONFIG_NAME):
+        findings.append(Finding(dirname, f"{SERVER_CONFIG_NAME} present but no requires-server, it is ignored", optional=True))
+    # TODO: v2 Container-req
+
+    # TODO: v2Machine-req
+
+    return findings
+
+
+def server_zip_has(server_zip_path, member):
+    """Looks the member up in the central directory instead of building the whole namelist"""
+    try:
+        with zipfile.ZipFile(server_zip_path) as server_zip:
+            server_zip.getinfo(member or "")
+        return True
+    except (KeyError, zipfile.BadZipFile):
+        return False
+
+
+def validate_pack(directory, index=None, jobs=1, cache=None, profiler=None) -> List[Finding]:
+    """
+    Validates every challenge of a pack over a pool of `jobs` workers. With a BuildCache, challenges
+    whose files have the same sizes and mtimes as when they were last checked reuse those findings.
+    Findings come back in index order.
+    """
+    if index is None:
+        index = PackIndex([directory])
+    entries = index.challenges_in(directory)
+
+    results = [None] * len(entries)
+    to_check = []
+    for i, entry in enumerate(entries):
+        cached = None if cache is None else cache.validated_findings(entry, VALIDATOR_VERSION)
+        if cached is not None:
+            results[i] = [Finding.from_dict(finding) for finding in cached]
+        else:
+            to_check.append(i)
+
+    check = validate_challenge
+    if profiler is not None:
+        def check(entry):
+            with profiler.stage("validate", entry.display_path):
+                return validate_challenge(entry)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs or 1)) as pool:
+        for i, findings in zip(to_check, pool.map(check, [entries[i] for i in to_check])):
+            results[i] = findings
+            if cache is not None:
+                cache.mark_validated(entries[i], [finding.as_dict() for finding in findings], VALIDATOR_VERSION)
+
+    return [finding for findings in results for finding in findings]
+
+
+ARCHIVE_NAMES = ("challenge.zip", "server.zip")
+
+
+def deep_validate_pack(directory, index, jobs=1, cache=None,
+                       max_size=DEFAULT_MAX_ARCHIVE_SIZE, max_ratio=DEFAULT_MAX_RATIO, profiler=None):
+    """
+    Verifies every challenge.zip and server.zip of a pack in parallel (see src.archive.verify_archive).
+    Archives that haven't changed since they were last verified are skipped when a cache is given.
+    Returns the findings and throughput stats for the report.
+    """
+    rules = [VERIFIER_VERSION, max_size, max_ratio]  # the limits decide problems as much as the checks
+    targets = []
+    findings = []
+    cached = 0
+    for entry in index.challenges_in(directory):
+        for name in ARCHIVE_NAMES:
+            if not entry.has(name):
+                continue
+            size, mtime_ns = entry.files[name]
+            problems = None if cache is None else cache.archive_problems(entry.path(name), size, mtime_ns, rules)
+            if problems is None:
+                targets.append((entry, name))
+            else:
+                cached += 1
+                findings += [Finding(entry.display_path, f"{name}: {problem}") for problem in problems]
+
+    start = time.monotonic()
+    checks = verify_archives([entry.path(name) for entry, name in targets], jobs, max_size, max_ratio)
+    seconds = time.monotonic() - start
+
+    for (entry, name), check in zip(targets, checks):
+        findings += [Finding(entry.display_path, f"{name}: {problem}") for problem in check.problems]
+        if profiler is not None:
+            profiler.record(name, check.start, check.seconds, challenge=entry.display_path)
+        if cache is not None:
+            size, mtime_ns = entry.files[name]
+            cache.mark_archive(check.path, size, mtime_ns, check.problems, rules)
+
+    stats = {"verified": len(checks),
+             "unchanged": cached,
+             "compressed_bytes": sum(check.compressed_bytes for check in checks),
+             "uncompressed_bytes": sum(check.uncompressed_bytes for check in checks),
+             "seconds": seconds,
+             "mb_per_s": throughput(checks, seconds)}
+    log_normal(f"{directory}: verified {stats['verified']} archives "
+               f"({stats['compressed_bytes'] / (1024 * 1024):.1f} MB) in {seconds:.2f}s, "
+               f"{stats['mb_per_s']:.1f} MB/s, {cached} unchanged archives skipped")
+    return findings, stats
+
+
+def report_findings(directory, findings: List[Finding], verbose=False):
+    """Prints the findings for a pack, returns 1 if the pack is invalid"""
+    for finding in findings:
+        if verbose or not finding.optional:
+            print(f"{finding.challenge}: {finding.message}")
+
+    if any(not finding.optional for finding in findings):
         log_error(f"{directory} is NOT a valid challenge pack")
         return(1)
     else:
         log_success(f"{directory} is a valid challenge pack")
         return(0)
+
+
+def validate_ctf_directory(directory, verbose=False, index=None, jobs=1, cache=None, profiler=None):
+    """Validates the directory structure of a given problem set"""
+    return report_findings(directory, validate_pack(directory, index, jobs, cache, profiler), verbose)
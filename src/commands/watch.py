@@ -0,0 +1,241 @@
+import argparse
+import os
+import subprocess
+import time
+from collections import Counter
+from typing import Dict, List, Set
+
+
+# "Common" code
+from src.cache import BuildCache
+from src.challenge import Challenge, dedupe_uploads, iter_ctfd_files, iter_ctfd_flags, make_challenges
+from src.commands import BaseCommand
+from src.commands.build import install_listener_daemon, install_listener_script, install_listener_table, \
+    prepare_service_challenges, provision_host, write_listener_table
+from src.commands.validate import VALIDATOR_VERSION, Finding, validate_challenge
+from src.export import BaseArchive, CtfdExport
+from src.pack import ChallengeEntry, PackIndex
+from src.ports import DEFAULT_PORT_RANGE, PortRegistry, parse_port_range
+from src.tui import log_error, log_normal, log_success, log_warn
+from src.watch import affected_challenges, debounce, open_watcher
+
+
+class Watchcmd(BaseCommand):
+    name = 'watch'
+    description = ('Rebuild challenges as they are edited')
+
+    def __init__(self):
+        super().__init__()
+
+    def subparser(self):
+        return None # overwrites do_x checking and uses __call__ instead
+
+    def __call__(self, argline):
+        parser = argparse.ArgumentParser(description=self.description)
+        parser.add_argument("directory", help="Directories of challenge packs to watch", nargs="+")
+        parser.add_argument("--basezip",
+                            help="Zip file to pull ctfd metadata from, use a fresh CTFd instance export if you need one",
+                            nargs=1,
+                            default=["resources/ctfd.base.zip"])
+        parser.add_argument("--name", default="ctf-tool", help="Name of the output zip file, updated in place as output/NAME.ctfd.zip")
+        parser.add_argument("--address", nargs=1, help="Server address to list in CTFd for participants to connect to")
+        parser.add_argument("--port-range",
+                            type=parse_port_range,
+                            default=DEFAULT_PORT_RANGE,
+                            help="Ports to give service challenges, FIRST-LAST (default %d-%d). Assignments are kept in output/ports.json" % DEFAULT_PORT_RANGE)
+        parser.add_argument("--install-listener",
+                            action='store_true',
+                            default=False,
+                            help="Install service challenges behind the listener daemon and reinstall them as they change")
+        parser.add_argument("--listener-workers",
+                            type=int,
+                            default=1,
+                            help="--install-listener: listener processes sharing the challenge ports with SO_REUSEPORT")
+        parser.add_argument("--no-make",
+                            action='store_true',
+                            default=False,
+                            help="Don't run `make` on challenges with Makefiles")
+        parser.add_argument("--no-make-clean",
+                            action='store_true',
+                            default=False,
+                            help="Don't run `make clean` but still use make")
+        parser.add_argument("-j", "--jobs",
+                            type=int,
+                            default=1,
+                            help="Number of challenges to run `make` on at once")
+        parser.add_argument("--debounce",
+                            type=float,
+                            default=0.2,
+                            help="Seconds without changes before rebuilding, so saving many files rebuilds once (default 0.2)")
+        parser.add_argument("--poll",
+                            action='store_true',
+                            default=False,
+                            help="Poll for changes instead of using inotify, e.g. on network or shared folders")
+        parser.add_argument("--interval",
+                            type=float,
+                            default=0.5,
+                            help="--poll: seconds between scans (default 0.5)")
+        args = parser.parse_args(argline)
+
+        if args.install_listener:
+            assert os.geteuid() == 0, "You must be root to install listener challenges!"
+
+        # watch before the first build so nothing saved while it runs is missed
+        watcher = open_watcher(args.directory, poll=args.poll, interval=args.interval)
+        if args.poll is False and watcher.kind != "inotify":
+            log_warn("inotify isn't available here, polling for changes instead")
+        try:
+            session = PackWatch(args)
+            session.rebuild({entry.directory for entry in session.index.challenges})
+            log_normal(f"Watching {', '.join(args.directory)} for changes ({watcher.kind}), Ctrl-C to stop")
+            while True:
+                directories, rescans = affected_challenges(debounce(watcher, args.debounce), args.directory)
+                session.rebuild(directories, rescans)
+        except KeyboardInterrupt:
+            log_normal("Stopped watching")
+        finally:
+            watcher.close()
+        return 0
+
+
+class PackWatch(object):
+    """
+    Build state of the watched packs kept between rebuilds: the pack index, the findings and Challenge
+    object of every challenge, and the fingerprint each challenge had in the export. A rebuild only
+    makes, validates and re-reads the challenges it is given, then rewrites the export (and the
+    listener table) from the Challenge objects of all of them.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.cache = BuildCache()
+        self.ports = PortRegistry(port_range=args.port_range)
+        self.base = BaseArchive(os.path.join(os.getcwd(), args.basezip[0]))
+        self.index = PackIndex(args.directory)
+        self.export_path = os.path.join(os.getcwd(), "output", f"{args.name}.ctfd.zip")
+        self.table_path = os.path.join("output", f"{args.name}.watch", "listeners.json")
+        os.makedirs(os.path.dirname(self.table_path), exist_ok=True)
+        self.findings = dict()     # type: Dict[str, List[Finding]]
+        self.make_failed = set()   # type: Set[str]
+        self.challenges = dict()   # type: Dict[str, Challenge]
+        self.exported = dict()     # challenge directory -> entry fingerprint in the current export
+        self.table = None          # listener table entries as last installed
+        self.daemon_installed = False
+
+    def rescan(self, pack) -> Set[str]:
+        """Picks up challenges added to or removed from a pack, returns the added directories"""
+        try:
+            scanned = PackIndex([pack]).packs[pack]
+        except OSError as e:
+            log_error(f"Can't scan {pack}: {e}")
+            return set()
+        known = {entry.directory: entry for entry in self.index.packs[pack]}
+        self.index.packs[pack] = [known.get(entry.directory, entry) for entry in scanned]
+        current = {entry.directory for entry in scanned}
+        for directory in known.keys() - current:
+            # still in self.exported, so the export is rewritten without it
+            self.findings.pop(directory, None)
+            self.challenges.pop(directory, None)
+            self.make_failed.discard(directory)
+            log_normal(f"{known[directory].display_path} was removed")
+        return current - known.keys()
+
+    def rebuild(self, directories: Set[str], rescans=()):
+        start = time.monotonic()
+        # same spelling as PackIndex entry directories (absolute and normalized) or nothing would match
+        directories = {os.path.abspath(directory) for directory in directories}
+        rescans = set(rescans)
+        # a challenge directory that disappeared without an event on its category (e.g. moved away)
+        rescans |= {entry.pack for entry in self.index.challenges
+                    if entry.directory in directories and not os.path.isdir(entry.directory)}
+        for pack in rescans:
+            directories |= self.rescan(pack)
+        entries = [entry for entry in self.index.challenges if entry.directory in directories]
+        for entry in entries:
+            entry.refresh()
+
+        if not self.args.no_make:
+            failures = make_challenges(self.index, self.args.no_make_clean, jobs=self.args.jobs,
+                                       cache=self.cache, directories=directories)
+            failed = {result.directory for result in failures}
+            self.make_failed = (self.make_failed - directories) | failed
+
+        for entry in entries:
+            cached = self.cache.validated_findings(entry, VALIDATOR_VERSION)
+            if cached is not None:
+                findings = [Finding.from_dict(finding) for finding in cached]
+            else:
+                findings = validate_challenge(entry)
+                self.cache.mark_validated(entry, [finding.as_dict() for finding in findings], VALIDATOR_VERSION)
+            self.findings[entry.directory] = findings
+            for finding in findings:
+                if not finding.optional:
+                    print(f"{finding.challenge}: {finding.message}")
+        self.cache.save()
+
+        # make writing into a challenge directory shows up as another change of it, nothing to export then
+        changed = [entry for entry in self.index.challenges if self.exported.get(entry.directory) != entry.fingerprint()]
+        removed = self.exported.keys() - {entry.directory for entry in self.index.challenges}
+        if not changed and not removed:
+            return
+
+        invalid = {directory for directory, findings in self.findings.items()
+                   if any(not finding.optional for finding in findings)} | self.make_failed
+        if invalid:
+            log_error(f"{len(invalid)} challenges have errors, keeping the last export until they are fixed")
+            return
+        self.update(changed)
+        log_success(f"Updated {self.export_path} in {time.monotonic() - start:.2f}s "
+                    f"({len(changed)} challenges changed, {len(removed)} removed)")
+
+    def update(self, changed: List[ChallengeEntry]):
+        """Re-reads the changed challenges and rewrites the export and the listener table"""
+        fresh = [Challenge(entry.directory, entry) for entry in changed]
+        for challenge in fresh:
+            self.challenges[challenge.directory] = challenge
+        challenges = [self.challenges[entry.directory] for entry in self.index.challenges]
+        duplicates = [name for name, count in Counter(challenge.name for challenge in challenges).items() if count > 1]
+        if duplicates:
+            log_error(f"Two or more challenges named {', '.join(duplicates)}, keeping the last export")
+            return
+        for i, challenge in enumerate(challenges):
+            challenge.id = i + 1
+
+        prepare_service_challenges(fresh, self.ports)
+        self.ports.save()
+        address = self.args.address[0] if self.args.address else None
+        services = [challenge for challenge in fresh if challenge.requires_server_path is not None]
+        if self.args.install_listener:
+            provision_host(services, address, "listener")
+        elif address is not None:
+            for challenge in services:
+                challenge.description += f"\n\nnc {address} {challenge.port}"
+
+        for challenge in challenges:
+            challenge.upload_location = None  # uploads another challenge shared may have changed
+        dedupe_uploads(challenges, self.cache.file_digest)
+        self.cache.save()
+        with CtfdExport(self.export_path) as export:
+            for challenge in challenges:
+                challenge.add_zip_file_to_export(export)
+            export.add_table("db/challenges.json", (challenge.ctfd_repr() for challenge in challenges), count=len(challenges))
+            export.add_table("db/files.json", iter_ctfd_files(challenges))
+            export.add_table("db/flags.json", iter_ctfd_flags(challenges))
+            export.merge_base(self.base)
+        self.exported = {entry.directory: entry.fingerprint() for entry in self.index.challenges}
+
+        table = write_listener_table(self.table_path + ".tmp", challenges)
+        os.replace(self.table_path + ".tmp", self.table_path)
+        if self.args.install_listener:
+            self.reload_listener(table)
+
+    def reload_listener(self, table):
+        """Installs the daemon on the first update, afterwards swaps its table and sends it a SIGHUP"""
+        if not self.daemon_installed:
+            install_listener_script()
+            install_listener_daemon(self.table_path, self.args.listener_workers)
+            self.daemon_installed = True
+        elif table != self.table:
+            install_listener_table(self.table_path)
+            if subprocess.run(["systemctl", "reload", "ctf-tool-listener.service"]).returncode != 0:
+                log_warn("Couldn't reload ctf-tool-listener.service, is it running?")
+        self.table = table
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from src.cache import sha256_of
+from src.tui import log_error, log_normal, log_success
+
+
+DEFAULT_LOG_DIR = os.path.join("output", "logs", "docker")
+
+
+def context_hash(path, digest=sha256_of, sources=None):
+    """
+    Content hash of a docker build context, images are tagged with it so unchanged contexts are never rebuilt.
+    sources maps files of the context (relative paths) to the files they were staged from, those are
+    hashed with digest at their stable source path so a cached digest doesn't record every build's
+    context. Other files (generated Dockerfiles) are small and hashed directly.
+    """
+    sources = sources or {}
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            relative = os.path.relpath(file_path, path)
+            source = sources.get(relative)
+            entries.append(f"{relative}\0{digest(source) if source is not None else sha256_of(file_path)}")
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+
+class ContainerEngine(ABC):
+    """What the orchestration needs from a container runtime"""
+    name = None
+
+    @abstractmethod
+    def image_exists(self, tag) -> bool:
+        pass
+
+    @abstractmethod
+    def build(self, context, tag, log) -> int:
+        """Builds context as tag writing output to the open log file, returns an exit code"""
+        pass
+
+    @abstractmethod
+    def run(self, container) -> int:
+        """(Re)starts a ContainerSpec, returns an exit code"""
+        pass
+
+
+class DockerEngine(ContainerEngine):
+    """The local docker daemon through the docker CLI"""
+    name = "docker"
+
+    def image_exists(self, tag):
+        return subprocess.run(["docker", "image", "inspect", tag],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def build(self, context, tag, log):
+        return subprocess.run(["docker", "build", "-t", tag, context],
+                              stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL).returncode
+
+    def run(self, container):
+        subprocess.run(["docker", "rm", "-f", container.name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        command = ["docker", "run", "-d", "-t", "--name", container.name, "--user", container.user]
+        for host_port, container_port in container.ports:
+            command += ["-p", f"{host_port}:{container_port}"]
+        return subprocess.run(command + [container.image], stdout=subprocess.DEVNULL).returncode
+
+
+class FakeEngine(ContainerEngine):
+    """
+    In-memory engine that records what it was asked to do, lets the whole --install-docker path
+    run without a daemon. Tags in fail_tags fail to build.
+    """
+    name = "fake"
+
+    def __init__(self, fail_tags=()):
+        self.images = set()
+        self.builds = []
+        self.containers = dict()
+        self.fail_tags = set(fail_tags)
+
+    def image_exists(self, tag):
+        return tag in self.images
+
+    def build(self, context, tag, log):
+        log.write(f"fake build of {context} as {tag}\n")
+        self.builds.append(tag)
+        if tag in self.fail_tags:
+            return 1
+        self.images.add(tag)
+        return 0
+
+    def run(self, container):
+        if container.image not in self.images:
+            return 1
+        self.containers[container.name] = container
+        return 0
+
+
+ENGINES = {engine.name: engine for engine in (DockerEngine, FakeEngine)}
+
+
+class ImageSpec(object):
+    """A build context and the tag its image gets"""
+    def __init__(self, name, context, repository, digest=sha256_of, sources=None):
+        self.name = name
+        self.context = context
+        self.tag = f"{repository}:{context_hash(context, digest, sources)[:16]}"
+
+
+class ContainerSpec(object):
+    def __init__(self, name, image, user, ports):
+        self.name = name
+        self.image = image
+        self.user = user
+        self.ports = ports  # [(host port, container port)]
+
+
+class ImageBuild(object):
+    """Outcome of building (or reusing) one image"""
+    def __init__(self, spec, log_path):
+        self.spec = spec
+        self.log_path = log_path
+        self.reused = False
+        self.returncode = 0
+        self.start = None  # time.monotonic()
+        self.seconds = 0.0
+
+    @property
+    def failed(self):
+        return self.returncode != 0
+
+
+def _build_image(engine, spec, log_dir):
+    result = ImageBuild(spec, os.path.join(log_dir, f"{spec.name}.log"))
+    start = result.start = time.monotonic()
+    if engine.image_exists(spec.tag):
+        result.reused = True
+    else:
+        with open(result.log_path, "w") as log:
+            result.returncode = engine.build(spec.context, spec.tag, log)
+    result.seconds = time.monotonic() - start
+    return result
+
+
+def build_images(engine: ContainerEngine, base: ImageSpec, images: List[ImageSpec], jobs=1, log_dir=DEFAULT_LOG_DIR) -> List[ImageBuild]:
+    """
+    Builds the base image, then every challenge image over a pool of `jobs` workers.
+    Images whose tag (the hash of their context) already exists are reused. Results are base first, then input order.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    base_result = _build_image(engine, base, log_dir)
+    if base_result.failed:
+        return [base_result]
+    with ThreadPoolExecutor(max_workers=max(1, jobs or 1)) as pool:
+        return [base_result] + list(pool.map(lambda spec: _build_image(engine, spec, log_dir), images))
+
+
+def report_image_builds(results: List[ImageBuild]) -> List[ImageBuild]:
+    """Prints per-image timings and failures, returns the failed builds"""
+    failures = [result for result in results if result.failed]
+    for result in results:
+        if result.failed:
+            log_error(f"building {result.spec.tag} failed ({result.returncode}), see {result.log_path}")
+        elif result.reused:
+            log_normal(f"{result.spec.tag}: unchanged, reused")
+        else:
+            log_normal(f"{result.spec.tag}: built in {result.seconds:.2f}s")
+    built = [result for result in results if not result.reused and not result.failed]
+    if not failures:
+        log_success(f"Built {len(built)} images, reused {len(results) - len(built)}")
+    return failures
+
+
+def run_containers(engine: ContainerEngine, containers: List[ContainerSpec]) -> List[ContainerSpec]:
+    """Starts every container, returns the ones that failed to start"""
+    failures = []
+    for container in containers:
+        if engine.run(container) != 0:
+            log_error(f"starting container {container.name} from {container.image} failed")
+            failures.append(container)
+    return failures
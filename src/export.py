@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import zipfile
+
+from src.cache import CACHE_DIR
+
+# Optional faster JSON encoder for big tables
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Formats that are already compressed, deflating them again only burns CPU
+STORED_EXTENSIONS = {".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst",
+                     ".png", ".jpg", ".jpeg", ".gif", ".mp3", ".mp4", ".pcap", ".pcapng"}
+
+COPY_CHUNK_SIZE = 1 << 20
+TABLE_BUFFER_SIZE = 1 << 16
+
+
+def compression_for(filename):
+    """ZIP_STORED for files that are already compressed, ZIP_DEFLATED for everything else"""
+    if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def encode_row(row) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(row)
+    return json.dumps(row).encode()
+
+
+def iter_ctfd_table(rows, count=None):
+    """
+    Encodes CTFd's {count, results, meta} table layout one row at a time.
+    If count isn't known up front it is written after the results, once every row was seen.
+    """
+    if count is not None:
+        yield f'{{"count": {count}, "results": ['.encode()
+    else:
+        yield b'{"results": ['
+    seen = 0
+    for row in rows:
+        if seen:
+            yield b", "
+        yield encode_row(row.as_dict())
+        seen += 1
+    if count is not None:
+        if seen != count:
+            raise ValueError(f"table promised {count} rows but produced {seen}")
+        yield b'], "meta": {}}'
+    else:
+        yield f'], "count": {seen}, "meta": {{}}}}'.encode()
+
+
+class CtfdExport(object):
+    """
+    Writes a CTFd import zip in-process. Entries are streamed into the archive straight from their
+    source files (ZIP64 where needed), nothing is staged on disk. The archive is written next to its
+    final path and only moved into place once it was closed without errors.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = f"{path}.partial"
+        self.zip = zipfile.ZipFile(self.temp_path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.zip.close()
+        if exc_type is None:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+        return False
+
+    def add_file(self, arcname, path, compress_type=None):
+        """Streams a file from disk into the archive"""
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = compression_for(path) if compress_type is None else compress_type
+        with open(path, "rb") as src, self.zip.open(zinfo, "w", force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        self.names.add(arcname)
+
+    def add_bytes(self, arcname, data, compress_type=zipfile.ZIP_DEFLATED, date_time=None):
+        """Writes an in-memory entry, e.g. a generated table"""
+        zinfo = arcname if date_time is None else zipfile.ZipInfo(arcname, date_time)
+        self.zip.writestr(zinfo, data, compress_type=compress_type)
+        self.names.add(arcname)
+
+    def add_table(self, arcname, rows, count=None):
+        """Streams a CTFd table from an iterable of rows, memory stays flat no matter how many there are"""
+        buffer = bytearray()
+        with self.zip.open(arcname, "w", force_zip64=True) as dst:
+            for chunk in iter_ctfd_table(rows, count):
+                buffer += chunk
+                if len(buffer) >= TABLE_BUFFER_SIZE:
+                    dst.write(buffer)
+                    buffer.clear()
+            dst.write(buffer)
+        self.names.add(arcname)
+
+    def merge_base(self, base):
+        """Copies every table of a BaseArchive that wasn't generated for this export"""
+        merged = []
+        for name, date_time, data in base.entries:
+            if name not in self.names:
+                self.add_bytes(name, data, date_time=date_time)
+                merged.append(name)
+        return merged
+
+
+class BaseArchive(object):
+    """
+    The db/ tables of a CTFd base export (--basezip). They are read straight out of the archive,
+    never extracted, and the parsed result is pickled to output/.cache/basezip so later builds
+    against the same unchanged zip don't open it at all. cache_dir=None skips the cache.
+    """
+    def __init__(self, path, cache_dir=CACHE_DIR):
+        self.path = os.path.abspath(path)
+        self.entries = []  # (name, date_time, data)
+        self.from_cache = False
+
+        stat = os.stat(self.path)
+        key = (self.path, stat.st_size, stat.st_mtime_ns)
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, "basezip", hashlib.sha1(self.path.encode()).hexdigest() + ".pickle")
+            try:
+                with open(cache_path, "rb") as f:
+                    cached_key, entries = pickle.load(f)
+                if cached_key == key:
+                    self.entries = entries
+                    self.from_cache = True
+                    return
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+                pass
+
+        with zipfile.ZipFile(self.path) as base_zip:
+            for info in base_zip.infolist():
+                if info.filename.startswith("db/") and not info.is_dir():
+                    self.entries.append((info.filename, info.date_time, base_zip.read(info)))
+
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + ".tmp", "wb") as f:
+                pickle.dump((key, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + ".tmp", cache_path)
@@ -0,0 +1,4 @@
+# Where `build --install-listener` puts the listener table and serves its metrics, kept out of
+# src/commands/build.py so commands reading them don't import the whole build command
+LISTENER_TABLE_PATH = "/etc/ctf-tool/listeners.json"
+LISTENER_METRICS_ADDRESS = "127.0.0.1:9750"  # read by `ctf-tool.py status`
@@ -0,0 +1,128 @@
+import asyncio
+import math
+import time
+from collections import Counter
+from typing import List
+
+
+READ_SIZE = 4096
+
+
+class LoadTarget(object):
+    """A service challenge to load, from a listeners.json row"""
+    def __init__(self, name, host, port, steps=None):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.steps = steps or []  # [{"send": text} | {"expect": text}], empty: connect, read, close
+
+
+class LoadResult(object):
+    """Outcome of loading one target"""
+    def __init__(self, target):
+        self.target = target
+        self.latencies = []  # seconds from connect to first byte of successful sessions
+        self.errors = Counter()
+        self.sessions = 0
+        self.seconds = 0.0
+
+    @property
+    def connections_per_second(self):
+        return self.sessions / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def error_rate(self):
+        return sum(self.errors.values()) / self.sessions if self.sessions else 0.0
+
+    def as_dict(self):
+        return {"name": self.target.name, "host": self.target.host, "port": self.target.port,
+                "sessions": self.sessions, "seconds": self.seconds,
+                "connections_per_second": self.connections_per_second,
+                "p50_seconds": percentile(self.latencies, 50), "p99_seconds": percentile(self.latencies, 99),
+                "error_rate": self.error_rate, "errors": dict(self.errors)}
+
+
+def percentile(values, q):
+    """Nearest rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+async def run_session(target: LoadTarget, timeout):
+    """
+    One client session: connect, follow the script, close.
+    Returns (seconds from connect to first byte, None) or (None, error kind).
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(target.host, target.port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None, "connect"
+
+    first_byte = None
+    buffer = b""
+
+    async def read_more():
+        nonlocal first_byte, buffer
+        data = await asyncio.wait_for(reader.read(READ_SIZE), max(0.0, start + timeout - loop.time()))
+        if data and first_byte is None:
+            first_byte = loop.time() - start
+        buffer += data
+        return data
+
+    try:
+        steps = target.steps or [{"expect": ""}]
+        for step in steps:
+            if "send" in step:
+                writer.write(step["send"].encode())
+                await writer.drain()
+            else:
+                expected = step["expect"].encode()
+                while first_byte is None or expected not in buffer:
+                    if not await read_more():
+                        return None, "closed" if first_byte is None else "expect"
+                buffer = buffer[buffer.index(expected) + len(expected):]
+        return first_byte, None
+    except asyncio.TimeoutError:
+        return None, "timeout"
+    except OSError:
+        return None, "reset"
+    finally:
+        writer.close()
+
+
+async def load_target(target: LoadTarget, connections, concurrency, timeout) -> LoadResult:
+    """Runs `connections` sessions against one target, at most `concurrency` at a time"""
+    result = LoadResult(target)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def client():
+        async with semaphore:
+            latency, error = await run_session(target, timeout)
+        result.sessions += 1
+        if error is None:
+            result.latencies.append(latency)
+        else:
+            result.errors[error] += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[client() for _ in range(connections)])
+    result.seconds = time.monotonic() - start
+    return result
+
+
+async def _load(targets, connections, concurrency, timeout, together):
+    if together:
+        return list(await asyncio.gather(*[load_target(target, connections, concurrency, timeout) for target in targets]))
+    return [await load_target(target, connections, concurrency, timeout) for target in targets]
+
+
+def run_loadtest(targets: List[LoadTarget], connections=100, concurrency=10, timeout=5.0, together=False) -> List[LoadResult]:
+    """
+    Loads each target in turn, or all of them at once with together=True to see what the host as a whole sustains.
+    Results are in target order.
+    """
+    return asyncio.run(_load(targets, connections, concurrency, timeout, together))
@@ -0,0 +1,88 @@
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from src.tui import log_error, log_normal, log_success, log_warn
+
+
+DEFAULT_LOG_DIR = os.path.join("output", "logs", "make")
+
+
+class MakeResult(object):
+    """Outcome of running the make targets for a single challenge"""
+    def __init__(self, directory, log_path):
+        self.directory = directory
+        self.log_path = log_path
+        self.clean_returncode = None
+        self.returncode = None
+        self.start = None  # time.monotonic()
+        self.duration = 0.0
+
+    @property
+    def failed(self):
+        return self.returncode not in (None, 0)
+
+
+def make_log_path(log_dir, directory):
+    """<log_dir>/<pack>.<category>.<challenge>.log with spaces replaced like upload names,
+    the pack keeps same-named challenges of different packs from sharing a log"""
+    category_dir = os.path.dirname(os.path.abspath(directory))
+    pack = os.path.basename(os.path.dirname(category_dir))
+    filename = "_".join(f"{pack}.{os.path.basename(category_dir)}.{os.path.basename(directory)}".split(" "))
+    return os.path.join(log_dir, f"{filename}.log")
+
+
+def _run_make(directory, log_path, clean, build):
+    result = MakeResult(directory, log_path)
+    start = result.start = time.monotonic()
+    with open(log_path, "w") as log:
+        if clean:
+            log.write(f"$ make clean -s -C {directory}\n")
+            log.flush()
+            result.clean_returncode = subprocess.run(["make", "clean", "-s", "-C", directory],
+                                                     stdout=log, stderr=subprocess.STDOUT,
+                                                     stdin=subprocess.DEVNULL).returncode
+        if build:
+            log.write(f"$ make -s -C {directory}\n")
+            log.flush()
+            result.returncode = subprocess.run(["make", "-s", "-C", directory],
+                                               stdout=log, stderr=subprocess.STDOUT,
+                                               stdin=subprocess.DEVNULL).returncode
+    result.duration = time.monotonic() - start
+    return result
+
+
+def run_make_jobs(directories: List[str], clean=True, build=True, jobs=1, log_dir=DEFAULT_LOG_DIR) -> List[MakeResult]:
+    """Runs `make clean` and/or `make` for every directory over a pool of `jobs` workers.
+    Each challenge gets its own log file in log_dir, results come back in input order"""
+    if not directories:
+        return []
+    os.makedirs(log_dir, exist_ok=True)
+    jobs = max(1, jobs or 1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_run_make, directory, make_log_path(log_dir, directory), clean, build)
+                   for directory in directories]
+        return [future.result() for future in futures]
+
+
+def report_make_results(results: List[MakeResult], tail=10) -> List[MakeResult]:
+    """Prints failures (with the end of their log) and a timing summary, returns the failed results"""
+    failures = [result for result in results if result.failed]
+    for result in results:
+        if result.clean_returncode not in (None, 0):
+            log_warn(f"`make clean` exited {result.clean_returncode} for {result.directory}, see {result.log_path}")
+    for result in failures:
+        log_error(f"`make` exited {result.returncode} for {result.directory}, see {result.log_path}")
+        with open(result.log_path, errors="replace") as log:
+            for line in log.read().splitlines()[-tail:]:
+                print(f"    {line}")
+    if results:
+        slowest = max(results, key=lambda result: result.duration)
+        total = sum(result.duration for result in results)
+        log_normal(f"make: {len(results)} challenges, {total:.2f}s of work, "
+                   f"slowest {os.path.basename(slowest.directory)} ({slowest.duration:.2f}s)")
+    if not failures and any(result.returncode is not None for result in results):
+        log_success(f"make succeeded for {len(results)} challenges")
+    return failures
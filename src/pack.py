@@ -0,0 +1,96 @@
+import os
+from typing import Dict, List
+
+
+class ChallengeEntry(object):
+    """One <pack>/<category>/<challenge> directory and the regular files at its top level"""
+    def __init__(self, pack, category, name, directory):
+        self.pack = pack            # pack directory as given on the command line
+        self.category = category
+        self.name = name
+        self.directory = directory  # absolute path
+        self.files = dict()         # filename -> (size, mtime_ns)
+        self.refresh()
+
+    @classmethod
+    def from_directory(cls, directory):
+        directory = os.path.abspath(directory)
+        category_dir = os.path.dirname(directory)
+        return cls(os.path.dirname(category_dir), os.path.basename(category_dir), os.path.basename(directory), directory)
+
+    @property
+    def display_path(self):
+        """Path relative to how the pack was given, used for messages"""
+        return f"{self.pack}/{self.category}/{self.name}"
+
+    def refresh(self):
+        """Re-reads the top level of the challenge directory, e.g. after make created files"""
+        files = dict()
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.is_file():
+                    stat = item.stat()
+                    files[item.name] = (stat.st_size, stat.st_mtime_ns)
+        self.files = files
+
+    def fingerprint(self):
+        """[[name, size, mtime_ns], ...] of the top-level files, JSON friendly for caches"""
+        return [[name, size, mtime] for name, (size, mtime) in sorted(self.files.items())]
+
+    def has(self, filename):
+        return filename in self.files
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @property
+    def has_makefile(self):
+        return "Makefile" in self.files
+
+    @property
+    def requires_server_path(self):
+        return self.path("requires-server") if "requires-server" in self.files else None
+
+
+class PackIndex(object):
+    """
+    In-memory index of every challenge in a set of challenge packs, built with a single os.scandir pass
+    over <pack>/<category>/<challenge>. Make, validate, challenge construction and server detection
+    all read from it instead of walking the tree themselves.
+    """
+    def __init__(self, directory_list: List[str]):
+        self.packs = dict()  # type: Dict[str, List[ChallengeEntry]]
+        for challenge_pack in directory_list:
+            self.packs[challenge_pack] = self._scan_pack(challenge_pack)
+
+    @staticmethod
+    def _scan_pack(challenge_pack):
+        entries = []
+        problem_dir = os.path.abspath(challenge_pack)  # canonical, entry directories key the caches
+        with os.scandir(problem_dir) as categories:
+            category_dirs = [category for category in categories if category.is_dir() and not category.name.startswith('.')]
+        for category in category_dirs:
+            with os.scandir(category.path) as challenges:
+                for challenge in challenges:
+                    if challenge.is_dir():
+                        entries.append(ChallengeEntry(challenge_pack, category.name, challenge.name, challenge.path))
+        return entries
+
+    @property
+    def challenges(self) -> List[ChallengeEntry]:
+        return [entry for entries in self.packs.values() for entry in entries]
+
+    def challenges_in(self, challenge_pack) -> List[ChallengeEntry]:
+        if challenge_pack not in self.packs:
+            self.packs[challenge_pack] = self._scan_pack(challenge_pack)
+        return self.packs[challenge_pack]
+
+    def makefile_dirs(self) -> List[str]:
+        return [entry.directory for entry in self.challenges if entry.has_makefile]
+
+    def refresh(self, directories: List[str]):
+        """Re-scans the given challenge directories"""
+        directories = set(directories)
+        for entry in self.challenges:
+            if entry.directory in directories:
+                entry.refresh()
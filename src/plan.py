@@ -0,0 +1,103 @@
+import json
+import re
+from typing import List
+
+
+class InventoryError(Exception):
+    pass
+
+
+HOST_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")  # also the name of the host's bundle directory
+
+
+class Demand(object):
+    """What one service challenge needs from its host, item is whatever is being placed (a Challenge)"""
+    def __init__(self, name, cpu, memory, item=None):
+        self.name = name
+        self.cpu = cpu
+        self.memory = memory
+        self.item = item
+
+
+class Host(object):
+    """A machine of the inventory and the challenges planned onto it"""
+    def __init__(self, name, address, cpu, memory):
+        self.name = name
+        self.address = address
+        self.cpu = cpu        # CPUs
+        self.memory = memory  # MB
+        self.demands = []     # type: List[Demand]
+
+    @property
+    def used_cpu(self):
+        return sum(demand.cpu for demand in self.demands)
+
+    @property
+    def used_memory(self):
+        return sum(demand.memory for demand in self.demands)
+
+    def fits(self, demand, headroom=0.0):
+        """Whether demand fits next to what is already planned, keeping a headroom fraction of the host free"""
+        usable = 1.0 - headroom
+        return (self.used_cpu + demand.cpu <= self.cpu * usable + 1e-9 and
+                self.used_memory + demand.memory <= self.memory * usable + 1e-9)
+
+    def as_dict(self):
+        return {"name": self.name, "address": self.address, "cpu": self.cpu, "memory": self.memory,
+                "used_cpu": round(self.used_cpu, 3), "used_memory": self.used_memory,
+                "challenges": [{"name": demand.name, "cpu": demand.cpu, "memory": demand.memory}
+                               for demand in self.demands]}
+
+
+def load_inventory(path) -> List[Host]:
+    """
+    Hosts of an inventory file, a JSON list (or {"hosts": [...]}) of {"name", "address", "cpu", "memory"}
+    with cpu in CPUs and memory in MB. address is what participants connect to, it defaults to name.
+    """
+    try:
+        with open(path) as f:
+            inventory = json.load(f)
+    except (OSError, ValueError) as e:
+        raise InventoryError(f"can't read inventory {path}: {e}")
+    if isinstance(inventory, dict):
+        inventory = inventory.get("hosts")
+    if not isinstance(inventory, list) or not inventory:
+        raise InventoryError(f"inventory {path} has no hosts")
+
+    hosts = []
+    for i, host in enumerate(inventory):
+        if not isinstance(host, dict) or any(key not in host for key in ("name", "cpu", "memory")):
+            raise InventoryError(f"host {i + 1} of {path} needs a name, cpu and memory")
+        name = str(host["name"])
+        if not HOST_NAME.match(name):
+            raise InventoryError(f"host name {name} may only contain letters, digits, '_', '.' and '-'")
+        if any(other.name == name for other in hosts):
+            raise InventoryError(f"host {name} is listed twice")
+        try:
+            cpu, memory = float(host["cpu"]), int(host["memory"])
+        except (TypeError, ValueError):
+            raise InventoryError(f"cpu and memory of host {name} must be numbers")
+        if cpu <= 0 or memory <= 0:
+            raise InventoryError(f"cpu and memory of host {name} must be more than 0")
+        hosts.append(Host(name, str(host.get("address") or name), cpu, memory))
+    return hosts
+
+
+def plan_hosts(demands: List[Demand], hosts: List[Host], headroom=0.0) -> List[Demand]:
+    """
+    First fit decreasing: the biggest challenges (by their larger share of the biggest host's CPU or
+    memory) are placed first, each on the first host in inventory order with room for both.
+    Deterministic for the same inputs. Returns the demands that fit on no host.
+    """
+    most_cpu = max(host.cpu for host in hosts)
+    most_memory = max(host.memory for host in hosts)
+    order = sorted(demands, key=lambda demand: (-max(demand.cpu / most_cpu, demand.memory / most_memory), demand.name))
+    unplaced = []
+    for demand in order:
+        for host in hosts:
+            if host.fits(demand, headroom):
+                host.demands.append(demand)
+                break
+        else:
+            unplaced.append(demand)
+    return unplaced
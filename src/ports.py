@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import socket
+from typing import Dict, List, Tuple
+
+
+REGISTRY_PATH = os.path.join("output", "ports.json")
+REGISTRY_VERSION = 1
+DEFAULT_PORT_RANGE = (48620, 58619)
+
+
+def parse_port_range(text) -> Tuple[int, int]:
+    """"FIRST-LAST" -> (first, last), both inclusive"""
+    first, _, last = text.partition("-")
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last <= 65535:
+        raise ValueError(f"{text} is not a port range like 48620-58619")
+    return first, last
+
+
+def stable_hash(name) -> int:
+    """Same number for the same name on every machine and run, unlike hash()"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], "big")
+
+
+class PortRegistry(object):
+    """
+    Ports of service challenges, kept in output/ports.json so a challenge keeps its port (and its
+    published nc line) across builds. New challenges start at a port derived from a stable hash of
+    their name and probe upwards to the first free one. Assignments of challenges that aren't in a
+    build are kept, so a challenge that comes back gets its old port.
+    """
+    def __init__(self, path=REGISTRY_PATH, port_range=DEFAULT_PORT_RANGE):
+        self.path = path
+        self.first, self.last = port_range
+        self.ports = dict()  # type: Dict[str, int]
+        self.load()
+        # assignments outside of the range (it changed) are dropped, their challenges get new ports
+        self.ports = {name: port for name, port in self.ports.items() if self.first <= port <= self.last}
+        self.taken = {port: name for name, port in self.ports.items()}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                registry = json.load(f)
+        except (OSError, ValueError):
+            return
+        if registry.get("version") == REGISTRY_VERSION:
+            self.ports = registry.get("ports", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": REGISTRY_VERSION, "ports": self.ports}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def assign(self, name) -> int:
+        """The registered port of a challenge, or the first free port from its hash onwards"""
+        if name in self.ports:
+            return self.ports[name]
+        if len(self.taken) >= self.size:
+            raise ValueError(f"every port of {self.first}-{self.last} is assigned, use a larger --port-range")
+        offset = stable_hash(name) % self.size
+        while self.first + offset in self.taken:
+            offset = (offset + 1) % self.size
+        port = self.first + offset
+        self.ports[name] = port
+        self.taken[port] = name
+        return port
+
+
+def port_is_free(port, host="0.0.0.0") -> bool:
+    """Whether a TCP port can be listened on right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # like the listeners, TIME_WAIT doesn't count
+        try:
+            s.bind((host, port))
+        except OSError:
+            return False
+    return True
+
+
+def ports_in_use(ports: List[int], host="0.0.0.0") -> List[int]:
+    return [port for port in ports if not port_is_free(port, host)]
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from src.tui import log_normal, print_object_table
+
+
+class Span(object):
+    """A timed stage of a command, or of one challenge within a stage"""
+    def __init__(self, name, start, seconds, challenge=None, thread=None):
+        self.name = name
+        self.start = start          # time.monotonic()
+        self.seconds = seconds
+        self.challenge = challenge  # display path of the challenge, None for whole stages
+        self.thread = thread
+
+    def as_dict(self):
+        return {"name": self.name, "start": self.start, "seconds": self.seconds, "challenge": self.challenge}
+
+
+class Profiler(object):
+    """
+    Wall clock time of each stage of a command, cheap enough to always be on. Stages can also record
+    per challenge spans (from any worker thread) for the slowest challenge summary and the trace.
+    """
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.spans = []
+
+    def record(self, name, start, seconds, challenge=None):
+        # list.append is atomic, pool workers can record without a lock
+        self.spans.append(Span(name, start, seconds, challenge, threading.get_ident()))
+
+    @contextmanager
+    def stage(self, name, challenge=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic() - start, challenge)
+
+    def stage_totals(self):
+        """name -> seconds of the whole stages in the order they first ran, repeated stages are added up"""
+        totals = OrderedDict()
+        for span in self.spans:
+            if span.challenge is None:
+                totals[span.name] = totals.get(span.name, 0.0) + span.seconds
+        return totals
+
+    def challenge_totals(self):
+        """challenge -> {stage name -> seconds} of the per challenge spans"""
+        totals = defaultdict(lambda: defaultdict(float))
+        for span in self.spans:
+            if span.challenge is not None:
+                totals[span.challenge][span.name] += span.seconds
+        return totals
+
+    def trace_events(self):
+        """The spans as Chrome trace events (chrome://tracing, Perfetto), one row per thread"""
+        threads = dict()
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            tid = threads.setdefault(span.thread, len(threads))
+            event = {"name": span.name if span.challenge is None else f"{span.name} {span.challenge}",
+                     "cat": "stage" if span.challenge is None else span.name,
+                     "ph": "X", "pid": os.getpid(), "tid": tid,
+                     "ts": round((span.start - self.origin) * 1e6), "dur": round(span.seconds * 1e6)}
+            if span.challenge is not None:
+                event["args"] = {"challenge": span.challenge}
+            events.append(event)
+        return events
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+
+
+class _StageRow(object):
+    def __init__(self, name, seconds, total):
+        self.stage = name
+        self.seconds = f"{seconds:.3f}"
+        self.share = f"{seconds / total:.0%}" if total else "-"
+
+
+class _ChallengeRow(object):
+    def __init__(self, challenge, stages):
+        self.challenge = challenge
+        self.seconds = f"{sum(stages.values()):.3f}"
+        self.stages = " ".join(f"{name}={seconds:.3f}" for name, seconds in stages.items())
+
+
+def report_profile(profiler, top=10, trace_path=None):
+    """Prints the time of every stage and the `top` slowest challenges, optionally writes a Chrome trace"""
+    stages = profiler.stage_totals()
+    total = sum(stages.values())
+    print_object_table([_StageRow(name, seconds, total) for name, seconds in stages.items()], align_left=['stage'])
+
+    challenges = profiler.challenge_totals()
+    slowest = sorted(challenges.items(), key=lambda item: sum(item[1].values()), reverse=True)[:top]
+    if slowest:
+        print_object_table([_ChallengeRow(challenge, stages) for challenge, stages in slowest], align_left=['challenge'])
+
+    if trace_path is not None:
+        profiler.write_trace(trace_path)
+        log_normal(f"Wrote a trace of {len(profiler.spans)} spans to {trace_path}, open it in chrome://tracing or ui.perfetto.dev")
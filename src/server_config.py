@@ -0,0 +1,68 @@
+import configparser
+
+
+SERVER_CONFIG_NAME = "server.ini"
+
+
+class ServerConfigError(Exception):
+    pass
+
+
+class ServerConfig(object):
+    """
+    Optional per challenge service settings from the [server] section of <challenge>/server.ini.
+    Every setting has a default, a challenge without the file behaves exactly as before.
+    """
+    # name -> (type, default, minimum)
+    SETTINGS = {
+        "warm_pool": (int, 0, 0),        # instances of the program kept spawned ahead of connections
+        "max_sessions": (int, 0, 0),     # concurrent connections, 0 = unlimited (split over listener workers)
+        "rate": (int, 0, 0),             # new connections per minute from one source address, 0 = unlimited (split over listener workers)
+        "session_timeout": (int, 0, 0),  # wall clock seconds a connection may last, 0 = unlimited
+        "rlimit_cpu": (int, 0, 0),       # RLIMIT_CPU of the program in seconds, 0 = unlimited
+        "rlimit_as": (int, 0, 0),        # RLIMIT_AS of the program in MB, 0 = unlimited
+        "rlimit_nproc": (int, 0, 0),     # RLIMIT_NPROC of the challenge user, 0 = unlimited
+        "cpu": (float, 0.0, 0),          # CPUs the challenge needs on its host, 0 = the planner's default
+        "memory": (int, 0, 0),           # MB the challenge needs on its host, 0 = the planner's default
+    }
+    # only read by build --plan, the listener doesn't enforce them
+    PLANNING_HINTS = ("cpu", "memory")
+
+    def __init__(self, **settings):
+        for name, (_, default, _) in self.SETTINGS.items():
+            setattr(self, name, settings.get(name, default))
+
+    @classmethod
+    def from_file(cls, path):
+        parser = configparser.ConfigParser()
+        try:
+            with open(path) as f:
+                parser.read_file(f)
+        except (OSError, configparser.Error) as e:
+            raise ServerConfigError(f"can't read {SERVER_CONFIG_NAME}: {e}")
+        if not parser.has_section("server"):
+            return cls()
+
+        settings = dict()
+        for name, value in parser.items("server"):
+            if name not in cls.SETTINGS:
+                raise ServerConfigError(f"unknown {SERVER_CONFIG_NAME} setting {name}")
+            kind, _, minimum = cls.SETTINGS[name]
+            try:
+                settings[name] = kind(value)
+            except ValueError:
+                raise ServerConfigError(f"{SERVER_CONFIG_NAME} setting {name} = {value} is not a {kind.__name__}")
+            if minimum is not None and settings[name] < minimum:
+                raise ServerConfigError(f"{SERVER_CONFIG_NAME} setting {name} must be at least {minimum}")
+        return cls(**settings)
+
+    @classmethod
+    def for_entry(cls, entry):
+        """The settings of a pack index entry, defaults if it has no server.ini"""
+        if not entry.has(SERVER_CONFIG_NAME):
+            return cls()
+        return cls.from_file(entry.path(SERVER_CONFIG_NAME))
+
+    def listener_settings(self):
+        """The settings challenge-listener.py reads from its table"""
+        return {name: getattr(self, name) for name in self.SETTINGS if name not in self.PLANNING_HINTS}
@@ -1,9 +1,17 @@
-from humanfriendly.tables import format_pretty_table
-import colorama
-colorama.init()
+# humanfriendly and colorama are imported on first use, they're most of the startup time of a command
+_colorama = None
+
+def _colors():
+    global _colorama
+    if _colorama is None:
+        import colorama
+        colorama.init()
+        _colorama = colorama
+    return _colorama.Fore, _colorama.Style
 
 def print_object_table(objects, align_left=['id','friendlyname']):
     if objects:
+        from humanfriendly.tables import format_pretty_table
         header = align_left + [attr for attr in objects[0].__dict__ if not attr.startswith("_") and not attr in align_left]
         table_contents = []
         for obj in objects:
@@ -16,13 +24,17 @@ def print_object_table(objects, align_left=['id','friendlyname']):
 
 # FTODO: investigate python logger
 def log_success(data):
-    print(colorama.Fore.GREEN + " [+]" + colorama.Style.RESET_ALL + " " + data)
+    Fore, Style = _colors()
+    print(Fore.GREEN + " [+]" + Style.RESET_ALL + " " + data)
 
 def log_warn(data):
-    print(colorama.Fore.YELLOW + " [!]" + colorama.Style.RESET_ALL + " " + data)
+    Fore, Style = _colors()
+    print(Fore.YELLOW + " [!]" + Style.RESET_ALL + " " + data)
 
 def log_error(data):
-    print(colorama.Fore.RED + " [!]" + colorama.Style.RESET_ALL + " " + data)
+    Fore, Style = _colors()
+    print(Fore.RED + " [!]" + Style.RESET_ALL + " " + data)
 
 def log_normal(data):
-    print(colorama.Fore.BLUE + " [*]" + colorama.Style.RESET_ALL + " " + data)
+    Fore, Style = _colors()
+    print(Fore.BLUE + " [*]" + Style.RESET_ALL + " " + data)
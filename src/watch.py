@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from typing import Dict, List, Set, Tuple
+
+
+# inotify(7) constants, not exposed by the stdlib
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_SIZE = 1 << 16
+
+# Editor swap and backup files, saving a file shouldn't count twice
+IGNORED_SUFFIXES = ("~", ".swp", ".swx", ".tmp")
+
+
+def is_ignored(path):
+    name = os.path.basename(path)
+    return name.startswith(".") or name.endswith(IGNORED_SUFFIXES) or name == "4913"  # vim's write test
+
+
+def _walk_dirs(directory):
+    """directory and every directory below it, hidden ones (.git) excluded"""
+    for root, dirs, _ in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        yield root
+
+
+class InotifyWatcher(object):
+    """Recursive inotify watch of a set of directories through libc, new directories are watched as they appear"""
+    kind = "inotify"
+
+    def __init__(self, directories: List[str]):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = [os.path.abspath(directory) for directory in directories]
+        self.paths = dict()  # type: Dict[int, str]
+        try:
+            for root in self.roots:
+                self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, directory):
+        for path in _walk_dirs(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    continue  # removed while we were walking
+                if error == errno.ENOSPC:
+                    raise OSError(error, "out of inotify watches, raise fs.inotify.max_user_watches or use --poll")
+                raise OSError(error, f"inotify_add_watch failed for {path}")
+            self.paths[wd] = path
+
+    def changes(self, timeout=None) -> Set[str]:
+        """Paths that changed, waiting up to timeout seconds (forever for None) for the first one"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.roots)  # events were lost, everything counts as changed
+                    continue
+                directory = self.paths.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.paths[wd]
+                    continue
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not is_ignored(path):
+                    self._add_tree(path)
+                changed.add(path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """Fallback where inotify isn't available: compares (size, mtime) of every file every interval seconds"""
+    kind = "polling"
+
+    def __init__(self, directories: List[str], interval=0.5):
+        self.roots = [os.path.abspath(directory) for directory in directories]
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = dict()
+        for root in self.roots:
+            for directory in _walk_dirs(root):
+                try:
+                    with os.scandir(directory) as it:
+                        for item in it:
+                            stat = item.stat(follow_symlinks=False)
+                            snapshot[item.path] = (stat.st_size, stat.st_mtime_ns, item.is_dir(follow_symlinks=False))
+                except OSError:
+                    continue  # removed while we were walking
+        return snapshot
+
+    def changes(self, timeout=None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(wait)
+            snapshot = self._scan()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(directories: List[str], poll=False, interval=0.5):
+    """An InotifyWatcher, or a PollingWatcher if poll is set or inotify can't be used here"""
+    if not poll:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError):  # AttributeError: no inotify in this libc (macOS, BSD)
+            pass
+    return PollingWatcher(directories, interval)
+
+
+def debounce(watcher, quiet=0.2, max_wait=1.0) -> Set[str]:
+    """
+    Blocks until something changes, then keeps collecting until nothing changed for `quiet`
+    seconds (or max_wait passed, so a steady stream of writes can't postpone a rebuild forever).
+    Editor swap and backup files are left out.
+    """
+    changed = set()
+    while not changed:
+        changed = {path for path in watcher.changes() if not is_ignored(path)}
+    deadline = time.monotonic() + max_wait
+    while time.monotonic() < deadline:
+        more = watcher.changes(min(quiet, deadline - time.monotonic()))
+        if not more:
+            break
+        changed |= {path for path in more if not is_ignored(path)}
+    return changed
+
+
+def affected_challenges(paths: Set[str], packs: List[str]) -> Tuple[Set[str], Set[str]]:
+    """
+    Sorts changed paths by the <pack>/<category>/<challenge> directory they are in.
+    Returns (challenge directories to rebuild, packs to re-scan because challenges came or went).
+    Challenge directories are absolute and normalized like PackIndex entry directories.
+    """
+    challenges, rescans = set(), set()
+    roots = {pack: os.path.abspath(pack) for pack in packs}
+    for path in paths:
+        for pack, root in roots.items():
+            relative = os.path.relpath(os.path.normpath(path), root)
+            if relative == os.curdir or relative.startswith(os.pardir):
+                if relative == os.curdir:
+                    rescans.add(pack)
+                continue
+            parts = relative.split(os.sep)
+            if parts[0].startswith("."):
+                continue
+            if len(parts) <= 2:
+                rescans.add(pack)  # a category or challenge directory itself
+            else:
+                challenges.add(os.path.join(root, parts[0], parts[1]))
+    return challenges, rescans